@@ -0,0 +1,245 @@
+"""LitePixel 性能基准
+
+无需显示器，直接调用 demo.py 中不依赖 Tk 的渲染/视口/历史/光晕模块，
+在 1~50 MP 的合成图上逐项计时，结果写成 JSON，可与保存的基线比较。
+
+    python bench.py                               # 默认尺寸 1,12,50 MP
+    python bench.py --sizes 1,4 --repeat 5 --out now.json
+    python bench.py --baseline baseline.json      # 有回归时退出码为 1
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+from PIL import Image, ImageChops, ImageDraw, __version__ as PIL_VERSION
+
+import demo
+
+CANVAS = (1600, 1000)                       # 模拟的画布可见区域
+VIEW_SCALES = (0.1, 0.25, 0.5, 1.0, 2.0)
+PARAMS = {'brightness': 1.1, 'contrast': 1.2, 'saturation': 1.3, 'sharpness': 1.0,
+          'blur': 0, 'rotate': 0, 'flip_h': False, 'flip_v': False, 'angle': 0.0}
+
+
+# --- 合成测试图 (确定性，每次运行内容相同) ---
+
+def synthetic_image(megapixels):
+    w = round((megapixels * 1e6 * 3 / 2) ** 0.5)
+    size = (w, round(megapixels * 1e6 / w))
+    r = Image.linear_gradient("L").resize(size)
+    g = Image.radial_gradient("L").resize(size)
+    b = Image.effect_mandelbrot((1000, 667), (-2.0, -1.0, 1.0, 1.0), 64).resize(size, Image.Resampling.BILINEAR)
+    return Image.merge("RGB", (r, g, ImageChops.add(b, r, scale=2)))
+
+
+def synthetic_layer(size):
+    lines = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(lines)
+    w, h = size
+    for i in range(20):
+        draw.line([(w * i / 20, h * 0.2), (w * (20 - i) / 20, h * 0.8)], fill=(255, 0, 0, 255), width=max(3, w // 300))
+    layer = demo.TiledLayer(size)
+    layer.paste(lines, (0, 0), lines.getchannel("A")) # 只分配线条经过的瓦片
+    return layer
+
+
+# --- 计量 ---
+
+def _rss():
+    """当前常驻内存 (字节)；只在有 /proc 的系统上可用"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class _RssSampler:
+    """后台每 2ms 采样一次 RSS，取区间内的峰值 (Pillow 的像素内存不经过 tracemalloc)"""
+
+    def __init__(self):
+        self.start = self.peak = _rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(0.002):
+            self.peak = max(self.peak, _rss())
+
+    def __enter__(self):
+        if self.start is not None: self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self.start is not None:
+            self._thread.join()
+            self.peak = max(self.peak, _rss())
+
+
+def measure(fn, setup=None, repeat=3):
+    """先不开 tracemalloc 计时 repeat 次，再单独跑一次统计内存和分配"""
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        gc.collect()
+        t = time.perf_counter()
+        fn(arg)
+        times.append((time.perf_counter() - t) * 1000)
+
+    arg = setup() if setup else None
+    gc.collect()
+    Image.core.reset_stats()
+    tracemalloc.start()
+    with _RssSampler() as rss:
+        fn(arg)
+    _, py_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = Image.core.get_stats()
+    return {
+        'wall_ms_min': round(min(times), 3),
+        'wall_ms_median': round(statistics.median(times), 3),
+        'py_peak_kb': round(py_peak / 1024, 1),
+        'rss_peak_mb': round((rss.peak - rss.start) / 2**20, 1) if rss.start is not None else None,
+        'pil_images': stats['new_count'],
+        'pil_blocks': stats['allocated_blocks'] + stats['reused_blocks'],
+    }
+
+
+# --- 基准项 ---
+
+def cases_for(img):
+    """返回 [(名称, fn, setup)]；fn(setup 的返回值) 是被计时的部分"""
+    pipeline = demo.RenderPipeline()
+    layer = synthetic_layer(img.size)
+    w, h = img.size
+    overlays = [demo.OverlayLayer(demo.generate_overlay(**spec), (w * (i + 1) / 6, h / 2), 0.8, blend)
+                for i, ((_, spec), blend) in enumerate(zip(demo.OVERLAY_PRESETS, ("normal", "screen", "add") * 2))]
+    adjusted = pipeline._adjust(img, PARAMS, 1.0)
+
+    cases = [
+        ("adjust.color", lambda _: demo.ColorEngine().apply(img, 1.1, 1.2, 1.3), None),
+        ("adjust.sharpness", lambda _: pipeline._adjust(img, dict(PARAMS, sharpness=2.0), 1.0), None),
+        ("adjust.blur", lambda _: pipeline._adjust(img, dict(PARAMS, blur=4), 1.0), None),
+        ("adjust.blur.serial", lambda _: demo.TiledFilter(1).apply(img, 2.0, 4), None),
+        ("adjust.blur.tiled", lambda _: demo.shared_filter().apply(img, 2.0, 4), None),
+        ("layer.paste", lambda _: pipeline._paste_layer(adjusted, layer), None),
+        ("overlay.composite", lambda copy: demo.composite_overlays(copy, overlays), lambda: adjusted.copy()),
+        ("geometry.rotate90", lambda _: pipeline._geometry(adjusted, demo.Geometry(90, flip_h=True), 0), None),
+        ("geometry.straighten", lambda _: pipeline._geometry(adjusted, demo.Geometry(angle=3.5), 3.5), None),
+        ("render.full", lambda _: demo.render_image(img, dict(PARAMS, blur=2), layer, overlays), None),
+        ("render.crop25", lambda _: demo.render_image(img, dict(PARAMS, blur=2, crop=(w // 4, h // 4, w * 3 // 4, h * 3 // 4)),
+                                                     layer, overlays), None),
+    ]
+
+    # 画布显示：冷启动 (金字塔 + 瓦片都要生成) 时渲染一屏可见区
+    for scale in VIEW_SCALES:
+        def view(vr, scale=scale):
+            dw, dh = vr.display_size(scale)
+            x0, y0 = max(0, (dw - CANVAS[0]) // 2), max(0, (dh - CANVAS[1]) // 2)
+            vr.render(scale, (x0, y0, x0 + CANVAS[0], y0 + CANVAS[1]))
+        def fresh_viewport():
+            vr = demo.ViewportRenderer()
+            vr.set_image(adjusted)
+            return vr
+        cases.append((f"canvas.view@{scale:g}", view, fresh_viewport))
+
+    # 历史：一次快照 + 一笔画覆盖约 1/4 画面的瓦片，再撤销
+    def history_setup():
+        return demo.HistoryManager(), layer.copy()
+    def snapshot(arg):
+        history, lay = arg
+        history.push({'image': img, 'layer': lay, 'params': dict(PARAMS)})
+        history.record(lay, (w // 4, h // 4, w * 3 // 4, h * 3 // 4))
+    def snapshot_undo(arg):
+        history, lay = arg
+        snapshot(arg)
+        history.undo({'image': img, 'layer': lay, 'params': dict(PARAMS)})
+    cases += [("history.snapshot", snapshot, history_setup), ("history.snapshot_undo", snapshot_undo, history_setup)]
+    return cases
+
+
+def run(sizes, repeat, only=None):
+    results = {}
+    # 光晕素材与图片尺寸无关，只测一次 (原来的 _ensure_halo_assets 已改为内存中程序化生成)
+    def halos(_):
+        demo.generate_overlay.cache_clear()
+        for _, spec in demo.OVERLAY_PRESETS: demo.generate_overlay(**spec)
+    if not only or any("halo" in o for o in only):
+        results["overlay.generate"] = dict(measure(halos, repeat=repeat), size_mp=None)
+        print(f"{'overlay.generate':28s} {results['overlay.generate']['wall_ms_min']:10.1f} ms")
+
+    for mp in sizes:
+        img = synthetic_image(mp)
+        for name, fn, setup in cases_for(img):
+            if only and not any(o in name for o in only): continue
+            key = f"{name}@{mp:g}MP"
+            results[key] = dict(measure(fn, setup, repeat), size_mp=mp)
+            r = results[key]
+            print(f"{key:28s} {r['wall_ms_min']:10.1f} ms  py峰值 {r['py_peak_kb']:8.0f} KB  "
+                  f"RSS峰值 {r['rss_peak_mb'] if r['rss_peak_mb'] is not None else '-'} MB  新建图 {r['pil_images']}")
+        del img
+    return results
+
+
+def compare(results, baseline, threshold, min_ms=2.0):
+    """返回回归项列表：最快一次比基线慢 threshold 以上且绝对差超过 min_ms"""
+    regressions = []
+    for key, r in sorted(results.items()):
+        b = baseline.get(key)
+        if not b: continue
+        new, old = r['wall_ms_min'], b['wall_ms_min']
+        ratio = new / old if old else float("inf")
+        flag = ratio > 1 + threshold and new - old > min_ms
+        print(f"{'回归' if flag else '    '} {key:28s} {old:10.1f} -> {new:10.1f} ms  ({ratio:5.2f}x)")
+        if flag: regressions.append(key)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="LitePixel 性能基准")
+    parser.add_argument("--sizes", default="1,12,50", help="测试图尺寸 (百万像素)，逗号分隔")
+    parser.add_argument("--repeat", type=int, default=3, help="每项计时次数，取最快一次比较")
+    parser.add_argument("--only", help="只跑名称包含这些关键字的项，逗号分隔")
+    parser.add_argument("--out", default="bench_results.json", help="结果文件")
+    parser.add_argument("--baseline", help="与之比较的基线结果文件")
+    parser.add_argument("--threshold", type=float, default=0.15, help="判定为回归的变慢比例")
+    args = parser.parse_args(argv)
+
+    sizes = [float(x) for x in args.sizes.split(",")]
+    only = args.only.split(",") if args.only else None
+    results = run(sizes, args.repeat, only)
+    report = {
+        'meta': {
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'python': platform.python_version(),
+            'pillow': PIL_VERSION,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} 项回归")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
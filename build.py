@@ -2,12 +2,16 @@
 import os
 import sys
 
-def build_executable():
-    """使用PyInstaller构建可执行文件"""
+def build_executable(onefile=False):
+    """使用PyInstaller构建可执行文件
+
+    默认 --onedir：--onefile 每次启动都要先把自身解压到临时目录，冷启动慢很多。
+    需要单文件分发时运行 python build.py --onefile。
+    """
     # 构建命令
     cmd = [
         "pyinstaller",
-        "--onefile",           # 打包成单个exe文件
+        "--onefile" if onefile else "--onedir", # 单文件 / 目录形式
         "--windowed",          # 不显示控制台窗口
         "--name=LitePixel",    # 可执行文件名
         "--hidden-import=PIL", # 隐式导入PIL模块
@@ -27,7 +31,10 @@ def build_executable():
     # 执行打包命令
     os.system(cmd_str)
     
-    print("打包完成！请在dist文件夹中查找LitePixel.exe文件。")
+    if onefile:
+        print("打包完成！请在dist文件夹中查找LitePixel.exe文件。")
+    else:
+        print("打包完成！请在dist/LitePixel文件夹中查找LitePixel.exe文件 (分发时复制整个文件夹)。")
 
 if __name__ == "__main__":
-    build_executable()
\ No newline at end of file
+    build_executable(onefile="--onefile" in sys.argv)
\ No newline at end of file
@@ -1,15 +1,2340 @@
+import time
+STARTUP_T0 = time.perf_counter() # 启动计时起点，尽量放在最前
+
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk, simpledialog
-from PIL import Image, ImageTk, ImageEnhance, ImageFilter, ImageOps, ImageDraw
-import platform
+from tkinter import filedialog, messagebox, ttk
+from PIL import Image
+# ImageTk / ImageEnhance / ImageFilter / ImageDraw、批处理用的 argparse
+# 都在第一次用到时才导入，缩短窗口出现前的时间
 import os
 import math
 import sys
 import tempfile  # <--- 新增引入临时文件夹模块
+import json
+import queue
+import concurrent.futures
+import functools
+import hashlib
+import struct
+import threading
+import weakref
+from collections import OrderedDict, deque, namedtuple
+
+# ================= 色彩引擎 =================
+# 亮度/对比度/饱和度三个 ImageEnhance 在数学上都是线性混合，
+# 可以折叠成一张每通道 LUT 或一个 3x4 颜色矩阵，只遍历一次像素。
+# 与链式 ImageEnhance 的结果逐像素误差不超过 2 级 (0-255)。
+
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)  # 与 Image.convert("L") 一致 (ITU-R 601-2)
+
+
+def _clip8(v):
+    return 0 if v < 0 else 255 if v > 255 else int(v)
+
+
+def _f32(v):
+    return struct.unpack("f", struct.pack("f", v))[0]
+
+
+def _blend8(in1, in2, alpha):
+    """按 Image.blend 的单精度运算和截断规则混合一个 8 位值"""
+    return _clip8(_f32(in1 + _f32(_f32(alpha) * (in2 - in1))))
+
+
+class ColorEngine:
+    """单次遍历的色彩调整 (亮度 -> 对比度 -> 饱和度)，统计量按 (源图, 区域) 缓存"""
+
+    def __init__(self):
+        # (id(源图), 区域) -> (弱引用, RGB 直方图, 每通道极值, 像素数)
+        # 原图和代理图会交替出现，裁剪后只统计裁剪区域，所以按图和区域分别缓存
+        self._stats_cache = {}
+        self._lock = threading.Lock()   # 渲染线程、主线程和导出线程共用一个引擎
+
+    def _stats(self, img, box=None):
+        # 直方图只在换源图或区域时计算一次，之后拖动滑块不再扫描
+        key = (id(img), box)
+        with self._lock:
+            entry = self._stats_cache.get(key)
+            if entry is not None and entry[0]() is img: return entry[1:]
+        region = img.crop(box) if box else img
+        entry = (weakref.ref(img), region.histogram(), region.getextrema(), max(1, region.size[0] * region.size[1]))
+        with self._lock:
+            self._stats_cache = {k: v for k, v in self._stats_cache.items() if v[0]() is not None}
+            self._stats_cache[key] = entry
+        return entry[1:]
+
+    def contrast_mean(self, img, brightness, box=None):
+        """ImageEnhance.Contrast 在增亮后图像 (box 区域) 上求的灰度均值，由缓存直方图直接推出"""
+        hist, _, count = self._stats(img, box)
+        means = []
+        for ch in range(3):
+            h = hist[ch * 256:(ch + 1) * 256]
+            means.append(sum(n * _blend8(0, v, brightness) for v, n in enumerate(h) if n) / count)
+        return int(sum(w * m for w, m in zip(LUMA_WEIGHTS, means)) + 0.5)
+
+    def apply(self, img, brightness=1.0, contrast=1.0, saturation=1.0, base=None, roi=None, padded=None):
+        """img 为 base.crop(padded) 时 (裁剪区域外扩了滤镜光晕)：对比度均值只统计 base 的 roi 区域，
+        与光晕宽度无关；截断判断按 padded。统计量都按 base 缓存，不随每次新裁出的 img 重算"""
+        if brightness == 1.0 and contrast == 1.0 and saturation == 1.0:
+            return img
+        if base is None: base = img
+        mean = self.contrast_mean(base, brightness, roi) if contrast != 1.0 else 0
+
+        # 饱和度为 1 时亮度+对比度只是每通道映射：一张 LUT，一次 point
+        lut = [_blend8(mean, _blend8(0, v, brightness), contrast) for v in range(256)]
+        if saturation == 1.0:
+            return img.point(lut * 3)
+
+        sat_rows = []
+        for i in range(3):
+            sat_rows.append([(1 - saturation) * w + (saturation if i == j else 0) for j, w in enumerate(LUMA_WEIGHTS)])
+
+        if self._clips(self._stats(base, padded)[1], brightness, contrast, mean):
+            # 中间结果会被截断，线性折叠不再成立：LUT 后再做一次饱和度矩阵
+            out = img.point(lut * 3)
+            return out.convert("RGB", tuple(v for row in sat_rows for v in row + [-0.5]))
+
+        # 无截断：三步合成为一个仿射矩阵，一次 convert 完成
+        gain = brightness * contrast
+        offset = mean * (1 - contrast)
+        matrix = []
+        for row in sat_rows:
+            matrix += [gain * v for v in row] + [offset - 0.5]
+        return img.convert("RGB", tuple(matrix))
+
+    def _clips(self, extrema, brightness, contrast, mean):
+        for lo, hi in extrema:
+            if hi * brightness > 255:
+                return True
+            for x in (lo * brightness, hi * brightness):
+                if not 0 <= mean + contrast * (x - mean) <= 255:
+                    return True
+        return False
+
+
+# ================= 直方图统计 =================
+# 统计量都在原图 (+绘画层) 的小代理上算：约 6.5 万像素，整幅扫一遍只要一两毫秒。
+# 代理按 factor x factor 整块 reduce 得到，画笔/马赛克只重算改动到的块，
+# 从直方图里减去旧块、加上新块，不必回到全分辨率重扫。
+
+HIST_PROXY_PIXELS = 1 << 16
+AUTO_LEVELS = (8, 247)          # 自动色阶把亮度 0.5% / 99.5% 分位拉到的目标值
+AUTO_SATURATION = 110           # 自动饱和度的目标平均 HSV 饱和度 (0-255)
+
+
+def _region_hist(img):
+    """R/G/B 三通道 + 亮度 + HSV 饱和度，共 5 x 256 个计数"""
+    return img.histogram() + img.convert("L").histogram() + img.convert("HSV").getchannel(1).histogram()
+
+
+class HistogramService:
+    """原图 + 绘画层的代理直方图、分位数与自动美化参数"""
+
+    CHANNELS = ("R", "G", "B", "L", "S")
+
+    def __init__(self):
+        self._base = self._layer = None   # 弱引用
+        self._stale = True
+        self.factor = 1
+        self.base_proxy = None            # 原图代理 (换图前不变)
+        self.proxy = None                 # 合成了绘画层的代理；改动时换成新对象，version +1
+        self._hist = None                 # 整幅代理的直方图，增量维护
+        self.version = 0
+        self.roi = None                   # 裁剪区域对应的代理块范围
+        self._roi_key = self._roi_hist = None
+        self._out_key = self._out_hist = None
+
+    def sync(self, base, layer=None, roi=None):
+        """绑定到当前原图、绘画层和裁剪区域 (原图坐标)：换原图时重建代理，换图层或 invalidate 后只重新合成图层"""
+        if self._base is None or self._base() is not base:
+            f = max(1, math.ceil(math.sqrt(base.size[0] * base.size[1] / HIST_PROXY_PIXELS)))
+            self._base, self.factor = weakref.ref(base), f
+            self.base_proxy = base.reduce(f) if f > 1 else base.copy()
+            self._stale = True
+        if self._stale or self._layer() is not layer:
+            self._layer = weakref.ref(layer) if layer is not None else lambda: None
+            self._rebuild()
+        self.roi = self._proxy_box(roi) if roi else None
+        return self
+
+    def invalidate(self):
+        """绘画层被整体原地改写 (撤销/重做) 后调用，下次 sync 时重新合成"""
+        self._stale = True
+
+    def _rebuild(self):
+        self.proxy = self.base_proxy.copy()
+        layer = self._layer()
+        bbox = layer.getbbox() if layer is not None else None
+        if bbox: self._paste_layer(layer, self._proxy_box(bbox))
+        self._hist = _region_hist(self.proxy)
+        self.version += 1
+        self._stale = False
+
+    def _proxy_box(self, box):
+        f, (pw, ph) = self.factor, self.proxy.size
+        return (max(0, math.floor(box[0] / f)), max(0, math.floor(box[1] / f)),
+                min(pw, math.ceil(box[2] / f)), min(ph, math.ceil(box[3] / f)))
+
+    def _paste_layer(self, layer, pbox):
+        # 源区域与整块网格对齐，reduce 结果和对整幅图层 reduce 后再裁剪相同
+        f, (w, h) = self.factor, layer.size
+        box = (pbox[0] * f, pbox[1] * f, min(w, pbox[2] * f), min(h, pbox[3] * f))
+        part = layer.crop(box)
+        if f > 1: part = part.reduce(f) # 先裁再 reduce：reduce(box=) 的耗时与整幅图相关
+        self.proxy.paste(part, pbox[:2], part)
+
+    def update(self, box):
+        """绘画层 box (原图坐标) 改动后只重算对应的代理块"""
+        if self._stale or self.proxy is None or self._layer() is None: return
+        pbox = self._proxy_box(box)
+        if pbox[0] >= pbox[2] or pbox[1] >= pbox[3]: return
+        old = _region_hist(self.proxy.crop(pbox))
+        self.proxy = self.proxy.copy() # 新对象：ColorEngine 按对象缓存统计量
+        self.proxy.paste(self.base_proxy.crop(pbox), pbox[:2])
+        self._paste_layer(self._layer(), pbox)
+        new = _region_hist(self.proxy.crop(pbox))
+        self._hist = [h + n - o for h, n, o in zip(self._hist, new, old)]
+        self.version += 1
+
+    @property
+    def hist(self):
+        """当前统计范围 (有裁剪时只含裁剪区域) 的 5 x 256 计数"""
+        if not self.roi: return self._hist
+        key = (self.version, self.roi)
+        if key != self._roi_key: # 裁剪区域在代理上只有几万像素，直接重扫
+            self._roi_key, self._roi_hist = key, _region_hist(self.proxy.crop(self.roi))
+        return self._roi_hist
+
+    def channel(self, name):
+        i = self.CHANNELS.index(name)
+        return self.hist[i * 256:(i + 1) * 256]
+
+    def mean(self, name="L"):
+        h = self.channel(name)
+        return sum(v * n for v, n in enumerate(h)) / max(1, sum(h))
+
+    def percentile(self, q, name="L"):
+        h = self.channel(name)
+        target, acc = q / 100 * sum(h), 0
+        for v, n in enumerate(h):
+            acc += n
+            if n and acc >= target: return v
+        return 255
+
+    def output_histogram(self, color_engine, params, overlays=()):
+        """调色 + 光晕之后的 RGB 直方图 (768 个计数)，参数不变时直接返回上次结果"""
+        key = (self.version, self.roi, params['brightness'], params['contrast'], params['saturation'],
+               tuple((id(o.image), tuple(o.pos), o.opacity, o.blend) for o in overlays))
+        if key != self._out_key:
+            src = self.proxy.crop(self.roi) if self.roi else self.proxy
+            img = color_engine.apply(src, params['brightness'], params['contrast'], params['saturation'],
+                                     self.proxy, self.roi, self.roi)
+            if overlays:
+                if self.roi: overlays = shift_overlays(overlays, self.roi[0] * self.factor, self.roi[1] * self.factor)
+                img = composite_overlays(img.copy() if img is self.proxy else img, overlays, 1 / self.factor)
+            self._out_key, self._out_hist = key, img.histogram()
+        return self._out_hist
+
+    def suggest_enhance(self):
+        """自动色阶 + 饱和度：返回 brightness / contrast / saturation
+        ColorEngine 的亮度+对比度是 out = b * (m + c * (x - m))，m 为亮度均值；
+        令分位点 lo -> AUTO_LEVELS[0]、hi -> AUTO_LEVELS[1] 可解出 b 和 c"""
+        lo, hi, m = self.percentile(0.5), self.percentile(99.5), max(1.0, self.mean("L"))
+        bc = (AUTO_LEVELS[1] - AUTO_LEVELS[0]) / max(1, hi - lo)
+        b = (AUTO_LEVELS[0] + bc * (m - lo)) / m
+        c = bc / b
+        s = self.mean("S")
+        sat = AUTO_SATURATION / s if s >= 8 else 1.0 # 近乎灰度的图不放大噪点色
+        clamp = lambda v, lo_, hi_: round(min(hi_, max(lo_, v)), 1)
+        return {'brightness': clamp(b, 0.5, 1.8), 'contrast': clamp(c, 1.0, 1.8), 'saturation': clamp(sat, 1.0, 1.6)}
+
+
+# ================= 性能剖析 =================
+# 各阶段用 with profiler.stage("名称") 包起来。关闭时 stage() 返回同一个空对象，
+# 开销只有一次属性判断；打开后按帧汇总，信息栏显示上一帧各阶段耗时和滚动 p50/p95。
+# 环境变量 LITEPIXEL_TRACE=文件路径 时全程记录，退出时写出 Chrome trace (chrome://tracing 打开)。
+
+PROFILE_TRACE_ENV = "LITEPIXEL_TRACE"
+PROFILE_WINDOW = 120     # p50/p95 统计最近多少帧
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "t0")
+
+    def __init__(self, profiler, name):
+        self.profiler, self.name = profiler, name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._record(self.name, self.t0, time.perf_counter())
+        return False
+
+
+class Profiler:
+    """按帧汇总的阶段计时；渲染线程和主线程都会调用"""
+
+    def __init__(self, enabled=False, trace_path=None):
+        self.trace_path = trace_path
+        self.enabled = enabled or bool(trace_path)
+        self.frame = {}                               # 当前帧: 阶段 -> 毫秒
+        self.last_frame = {}
+        self.frame_times = deque(maxlen=PROFILE_WINDOW)
+        self._events = []                             # Chrome trace 事件
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        if not self.enabled: return _NULL_SPAN
+        return _Span(self, name)
+
+    def _record(self, name, t0, t1):
+        with self._lock:
+            self.frame[name] = self.frame.get(name, 0.0) + (t1 - t0) * 1000
+            if self.trace_path:
+                self._events.append({"name": name, "ph": "X", "ts": t0 * 1e6, "dur": (t1 - t0) * 1e6,
+                                     "pid": os.getpid(), "tid": threading.get_ident()})
+
+    def end_frame(self):
+        """一帧画到屏幕上之后调用"""
+        if not self.enabled: return
+        with self._lock:
+            self.last_frame, self.frame = self.frame, {}
+            if self.last_frame: self.frame_times.append(sum(v for k, v in self.last_frame.items() if "." not in k))
+
+    def percentile(self, q):
+        times = sorted(self.frame_times)
+        if not times: return 0.0
+        return times[min(len(times) - 1, int(q * len(times)))]
+
+    def hud_text(self):
+        stages = " ".join(f"{k} {v:.1f}" for k, v in self.last_frame.items())
+        return f"{stages} | p50 {self.percentile(0.5):.1f}ms p95 {self.percentile(0.95):.1f}ms"
+
+    def dump_trace(self, path=None):
+        path = path or self.trace_path
+        if not path: return
+        with self._lock:
+            events = list(self._events)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def profiled(name):
+    """给 ImageEditorApp 的事件处理方法计时 (关闭时只多一次属性判断)"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if not self.profiler.enabled: return fn(self, *args, **kwargs)
+            with self.profiler.stage(name):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# ================= 几何变换 =================
+# 90 度倍数的旋转和翻转属于二面体群 D4，任意组合都等于其中一个元素，用一次无损 transpose 完成。
+# 任意角度的"拉直"预览时不在整图上做，而是和视口缩放合成一个仿射变换，直接采样到屏幕大小；
+# 导出时才整图旋转。指针 -> 原图坐标的换算统一走 Geometry.inverse。
+
+_D4_TRANSPOSE = {   # (a, b, c, d): x' = a*x + b*y, y' = c*x + d*y (y 轴向下) -> 对应的 transpose
+    (1, 0, 0, 1): None,
+    (-1, 0, 0, 1): Image.Transpose.FLIP_LEFT_RIGHT,
+    (1, 0, 0, -1): Image.Transpose.FLIP_TOP_BOTTOM,
+    (-1, 0, 0, -1): Image.Transpose.ROTATE_180,
+    (0, 1, -1, 0): Image.Transpose.ROTATE_90,     # 逆时针 90 度
+    (0, -1, 1, 0): Image.Transpose.ROTATE_270,    # 顺时针 90 度
+    (0, 1, 1, 0): Image.Transpose.TRANSPOSE,
+    (0, -1, -1, 0): Image.Transpose.TRANSVERSE,
+}
+
+
+def rotated_size(w, h, angle):
+    """w x h 的图旋转 angle 度后外接框的尺寸"""
+    t = math.radians(angle)
+    cs, sn = abs(math.cos(t)), abs(math.sin(t))
+    return w * cs + h * sn, w * sn + h * cs
+
+
+class Geometry:
+    """params 中 rotate (顺时针) -> flip_h -> flip_v -> angle (顺时针拉直) 合成的变换"""
+
+    def __init__(self, rotate=0, flip_h=False, flip_v=False, angle=0.0):
+        steps = round(rotate / 90)
+        self.angle = angle + rotate - steps * 90 # rotate 不是 90 度倍数的部分并入任意角度
+        a, b, c, d = 1, 0, 0, 1
+        for _ in range(steps % 4):
+            a, b, c, d = -c, -d, a, b # 左乘顺时针 90 度：(x, y) -> (-y, x)
+        if flip_h: a, b = -a, -b
+        if flip_v: c, d = -c, -d
+        self.m = (a, b, c, d)
+
+    @classmethod
+    def from_params(cls, params):
+        return cls(params.get('rotate', 0), params.get('flip_h', False), params.get('flip_v', False),
+                   params.get('angle', 0.0))
+
+    @property
+    def transpose(self):
+        return _D4_TRANSPOSE[self.m]
+
+    def d4_size(self, size):
+        return (size[1], size[0]) if self.m[1] else tuple(size)
+
+    def size(self, size):
+        """原图尺寸为 size 时输出图 (含拉直后的外接框) 的尺寸"""
+        w, h = self.d4_size(size)
+        return rotated_size(w, h, self.angle) if self.angle else (w, h)
+
+    def apply(self, img):
+        """只做 D4 部分 (一次 transpose)"""
+        return img.transpose(self.transpose) if self.transpose is not None else img
+
+    def _offset(self, size):
+        a, b, c, d = self.m
+        w, h = size
+        return (w if a < 0 else 0) + (h if b < 0 else 0), (w if c < 0 else 0) + (h if d < 0 else 0)
+
+    def box(self, box, size):
+        """原图坐标中的矩形经 D4 变换后的位置"""
+        a, b, c, d = self.m
+        tx, ty = self._offset(size)
+        xs = (a * box[0] + b * box[1] + tx, a * box[2] + b * box[3] + tx)
+        ys = (c * box[0] + d * box[1] + ty, c * box[2] + d * box[3] + ty)
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def forward(self, x, y, size):
+        """原图坐标 -> 输出图坐标 (连续坐标，拉直时以外接框左上角为原点)"""
+        a, b, c, d = self.m
+        tx, ty = self._offset(size)
+        x, y = a * x + b * y + tx, c * x + d * y + ty
+        if not self.angle: return x, y
+        (w, h), (ow, oh) = self.d4_size(size), self.size(size)
+        t = math.radians(self.angle)
+        cs, sn = math.cos(t), math.sin(t)
+        x, y = x - w / 2, y - h / 2
+        return cs * x - sn * y + ow / 2, sn * x + cs * y + oh / 2
+
+    def inverse(self, x, y, size):
+        """输出图坐标 -> 原图坐标，forward 的逆"""
+        if self.angle:
+            (w, h), (ow, oh) = self.d4_size(size), self.size(size)
+            t = math.radians(self.angle)
+            cs, sn = math.cos(t), math.sin(t)
+            x, y = x - ow / 2, y - oh / 2
+            x, y = cs * x + sn * y + w / 2, -sn * x + cs * y + h / 2
+        a, b, c, d = self.m
+        tx, ty = self._offset(size)
+        x, y = x - tx, y - ty
+        return a * x + c * y, b * x + d * y # 正交矩阵的逆是转置
+
+
+# ================= 分块并行滤镜 =================
+# 锐化 (与 3x3 SMOOTH 的混合) 和高斯模糊 (Pillow 用 3 次盒式模糊近似) 都只看邻域像素。
+# 把图按行切成带上下光晕边的条带，在线程池上分别滤波后裁掉光晕拼回；光晕宽度覆盖滤镜的
+# 全部影响范围，结果与整图一次调用逐像素相同。Pillow 滤波时释放 GIL，线程可以吃满多核。
+
+FILTER_MIN_PIXELS = 1 << 20      # 小于此像素数直接整图处理 (代理渲染、缩略图)
+FILTER_BAND_ROWS = 256           # 条带最小高度；光晕较宽时按光晕的 4 倍放大，控制重复计算
+
+
+def _blur_halo(radius):
+    """GaussianBlur(radius) 的影响半径：3 次盒式模糊，每次最多 int(r) + 1 像素，盒半径不超过 radius"""
+    return 3 * (math.ceil(radius) + 1)
+
+
+def filter_halo(sharpness, blur):
+    """锐化 + 模糊合起来的影响半径 (像素)"""
+    return (1 if sharpness != 1.0 else 0) + (_blur_halo(blur) if blur > 0 else 0)
+
+
+def _neighborhood_filters(img, sharpness, blur):
+    from PIL import ImageEnhance, ImageFilter
+    if sharpness != 1.0: img = ImageEnhance.Sharpness(img).enhance(sharpness)
+    if blur > 0: img = img.filter(ImageFilter.GaussianBlur(blur))
+    return img
+
+
+class TiledFilter:
+    """锐化 + 高斯模糊的分块并行执行器；线程池第一次用到时才创建"""
+
+    def __init__(self, threads=None):
+        self.threads = threads or os.cpu_count() or 1
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix="filter")
+            return self._pool
+
+    def apply(self, img, sharpness=1.0, blur=0):
+        """先锐化再模糊，与 ImageEnhance.Sharpness + GaussianBlur 的结果相同；不修改 img"""
+        if sharpness == 1.0 and blur <= 0: return img
+        w, h = img.size
+        halo = filter_halo(sharpness, blur)
+        n = min(self.threads, h // max(FILTER_BAND_ROWS, 4 * halo))
+        if n < 2 or w * h < FILTER_MIN_PIXELS:
+            return _neighborhood_filters(img, sharpness, blur)
+
+        bounds = [h * i // n for i in range(n + 1)]
+        def band(i):
+            y0, y1 = bounds[i], bounds[i + 1]
+            top, bottom = max(0, y0 - halo), min(h, y1 + halo)
+            # 光晕在图像边界处截断，与整图滤波时的边界处理一致
+            out = _neighborhood_filters(img.crop((0, top, w, bottom)), sharpness, blur)
+            return out.crop((0, y0 - top, w, y1 - top))
+
+        result = Image.new(img.mode, img.size)
+        for i, part in enumerate(self._executor().map(band, range(n))):
+            result.paste(part, (0, bounds[i]))
+        return result
+
+
+_shared_filter = None
+
+
+def shared_filter():
+    """进程内共用的滤镜执行器 (批处理工作进程在初始化时按 --threads 替换)"""
+    global _shared_filter
+    if _shared_filter is None: _shared_filter = TiledFilter()
+    return _shared_filter
+
+
+# ================= 渲染流水线 =================
+# 四个阶段：色彩底图 -> 绘画层合成 -> 光晕合成 -> 几何变换。
+# 每个阶段的输出按 (输入对象, 版本, 参数) 缓存，拖光晕只重算光晕及之后的阶段，
+# 画笔抬起只重算绘画层及之后的阶段。
+# 裁剪是参数 params['crop'] (原图坐标)：各阶段只处理裁剪区域，原图和绘画层保持不变。
+
+PROXY_IDLE_MS = 250                       # 停止拖动多久后补一次全分辨率渲染
+RENDER_CACHE_BYTES = 512 * 1024 * 1024    # 阶段缓存的内存上限
+
+
+def _image_nbytes(img):
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+def crop_box(params, size, scale=1.0):
+    """params['crop'] 换算到缩放为 scale 的底图上并裁到图内；没有裁剪 (或裁剪覆盖整图) 时返回 None"""
+    crop = params.get('crop')
+    if not crop: return None
+    w, h = size
+    box = (max(0, math.floor(crop[0] * scale)), max(0, math.floor(crop[1] * scale)),
+           min(w, math.ceil(crop[2] * scale)), min(h, math.ceil(crop[3] * scale)))
+    if box == (0, 0, w, h) or box[0] >= box[2] or box[1] >= box[3]: return None
+    return box
+
+
+def shift_overlays(overlays, dx, dy):
+    """光晕位置平移 (原图坐标)，用于换到裁剪区域或局部块的坐标系"""
+    return [o._replace(pos=(o.pos[0] - dx, o.pos[1] - dy)) for o in overlays]
+
+
+class StageCache:
+    """阶段输出的 LRU 缓存，总字节数不超过 max_bytes；输入图被回收时相关条目自动失效"""
+
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()   # key -> image
+        self._watched = {}              # id(输入图) -> weakref.finalize
+        self._lock = threading.RLock()  # 渲染线程、主线程和 GC 回调都会访问
+
+    def token(self, obj):
+        """输入图的缓存标识；对象被回收后以它为依赖的条目一并丢弃"""
+        if obj is None: return None
+        oid = id(obj)
+        with self._lock:
+            if oid not in self._watched:
+                self._watched[oid] = weakref.finalize(obj, self._forget, oid)
+        return oid
+
+    def get(self, key):
+        with self._lock:
+            img = self._entries.get(key)
+            if img is not None:
+                self._entries.move_to_end(key)
+            return img
+
+    def put(self, key, img):
+        size = _image_nbytes(img)
+        if size > self.max_bytes: return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= _image_nbytes(self._entries.pop(key))
+            self._entries[key] = img
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= _image_nbytes(old)
+
+    def invalidate(self, stage=None):
+        """丢弃某个阶段 (默认全部) 的缓存"""
+        with self._lock:
+            for key in [k for k in self._entries if stage is None or k[0] == stage]:
+                self.nbytes -= _image_nbytes(self._entries.pop(key))
+
+    def _forget(self, oid):
+        with self._lock:
+            self._watched.pop(oid, None)
+            for key in [k for k in self._entries if oid in k[1]]:
+                self.nbytes -= _image_nbytes(self._entries.pop(key))
+
+
+class RenderPipeline:
+    """分阶段渲染；返回的图可能直接来自缓存，调用方不得原地修改"""
+
+    STAGES = ("adjust", "layer", "overlay", "geometry")
+
+    def __init__(self, color_engine=None, cache=None, profiler=None, filters=None):
+        self.color_engine = color_engine or ColorEngine()
+        self.filters = filters or shared_filter()
+        self.cache = cache   # None 表示不缓存 (一次性渲染，如保存)
+        self.profiler = profiler or Profiler()
+
+    def _cached(self, stage, deps, key_params, build):
+        key = (stage, deps, key_params)
+        if self.cache is not None:
+            img = self.cache.get(key)
+            if img is not None: return img, key
+        with self.profiler.stage(stage):
+            img = build()
+        # 恒等阶段 (如参数全为默认) 会原样返回输入图；缓存它会强引用自己的失效对象，finalize 永远不触发
+        if self.cache is not None and id(img) not in deps: self.cache.put(key, img)
+        return img, key
+
+    def _token(self, obj):
+        return self.cache.token(obj) if self.cache is not None else id(obj)
+
+    def render(self, base, params, layer=None, overlays=(), scale=1.0, layer_version=0, cancelled=None,
+               free_angle=True):
+        """overlays 为 OverlayLayer 序列 (自下而上)。free_angle=False 时不做任意角度拉直 (预览交给视口)。
+        scale 是 base 相对原图的缩放 (代理预览 < 1)：模糊半径、光晕尺寸和位置按它换算，
+        layer 需与 base 同尺寸。cancelled() 为真时在阶段之间抛出 RenderCancelled。"""
+        def checkpoint():
+            if cancelled and cancelled(): raise RenderCancelled()
+
+        deps = (self._token(base),)
+        roi = crop_box(params, base.size, scale)
+
+        # 1. 色彩 (亮度/对比度/饱和度一次遍历完成) + 锐化/模糊，只算裁剪区域
+        img, key = self._adjust_stage(base, params, scale, roi)
+
+        # 2. 叠加绘画层
+        checkpoint()
+        if layer is not None and not _layer_empty(layer, roi):
+            deps += (self._token(layer),)
+            img, key = self._cached("layer", deps, (key, layer_version), lambda src=img: self._paste_layer(src, layer, roi))
+
+        # 3. 叠加光晕栈 (Overlay)
+        checkpoint()
+        if overlays:
+            if roi: overlays = shift_overlays(overlays, roi[0] / scale, roi[1] / scale)
+            overlays = tuple(OverlayLayer(o.image, tuple(o.pos), o.opacity, o.blend) for o in overlays)
+            deps += tuple(self._token(o.image) for o in overlays)
+            layer_params = tuple(o[1:] for o in overlays)
+            img, key = self._cached("overlay", deps, (key, layer_params),
+                                    lambda src=img: composite_overlays(src.copy(), overlays, scale))
+
+        # 4. 全局几何变换 (最后执行，保证所有元素一起转)
+        checkpoint()
+        geo = Geometry.from_params(params)
+        angle = geo.angle if free_angle else 0
+        if geo.transpose is not None or angle:
+            img, key = self._cached("geometry", deps, (key, geo.m, angle), lambda src=img: self._geometry(src, geo, angle))
+        return img
+
+    def render_region(self, base, params, layer, overlays, box):
+        """只合成原图坐标 box 内的一块 (绘画时增量刷新用)，复用缓存的调整结果。
+        返回 (D4 变换后的小图, 它在 free_angle=False 的完整输出图中的左上角)；box 在裁剪区域外时返回 None"""
+        roi = crop_box(params, base.size) or (0, 0) + base.size
+        box = (max(box[0], roi[0]), max(box[1], roi[1]), min(box[2], roi[2]), min(box[3], roi[3]))
+        if box[0] >= box[2] or box[1] >= box[3]: return None
+        adjusted, _ = self._adjust_stage(base, params, 1.0, crop_box(params, base.size))
+        bx, by = box[0], box[1]
+        patch = adjusted.crop((bx - roi[0], by - roi[1], box[2] - roi[0], box[3] - roi[1]))
+        if layer is not None and not _layer_empty(layer, box):
+            composite_layer(patch, layer, box)
+        if overlays:
+            composite_overlays(patch, shift_overlays(overlays, bx, by))
+        geo = Geometry.from_params(params)
+        x0, y0, _, _ = geo.box((bx - roi[0], by - roi[1], box[2] - roi[0], box[3] - roi[1]),
+                               (roi[2] - roi[0], roi[3] - roi[1]))
+        return geo.apply(patch), (x0, y0)
+
+    def _adjust_stage(self, base, params, scale, roi=None):
+        adjust_params = tuple(params[k] for k in ('brightness', 'contrast', 'saturation', 'sharpness', 'blur')) + (scale, roi)
+        return self._cached("adjust", (self._token(base),), adjust_params, lambda: self._adjust(base, params, scale, roi))
+
+    def _adjust(self, base, params, scale, roi=None):
+        sharpness, blur = params['sharpness'], params['blur'] * scale
+        src = base
+        if roi:
+            # 裁剪区域外扩滤镜影响半径后再处理，边缘与整图处理后再裁剪一致
+            halo = filter_halo(sharpness, blur)
+            w, h = base.size
+            padded = (max(0, roi[0] - halo), max(0, roi[1] - halo), min(w, roi[2] + halo), min(h, roi[3] + halo))
+            src = base.crop(padded)
+        img = self.color_engine.apply(src, params['brightness'], params['contrast'], params['saturation'],
+                                      base, roi, padded if roi else None) # 均值只统计裁剪区域，不含光晕
+        img = self.filters.apply(img, sharpness, blur)
+        if roi:
+            img = img.crop((roi[0] - padded[0], roi[1] - padded[1], roi[2] - padded[0], roi[3] - padded[1]))
+        return img
+
+    def _paste_layer(self, src, layer, roi=None):
+        return composite_layer(src.copy(), layer, roi)
+
+    def _geometry(self, img, geo, angle):
+        img = geo.apply(img) # 旋转 + 翻转合成一次无损 transpose
+        if angle: img = img.rotate(-angle, Image.Resampling.BICUBIC, expand=True)
+        return img
+
+
+class RenderCancelled(Exception):
+    """渲染请求已被更新的请求取代"""
+
+
+class RenderScheduler:
+    """后台单线程渲染，新请求覆盖旧请求 (latest-wins)
+
+    submit() 只保留最新的一个待渲染任务，被覆盖或中途过期的任务计入 dropped；
+    结果由主线程上的 after() 轮询取回并交给 on_done，计入 completed。
+    """
+
+    POLL_MS = 15
+
+    def __init__(self, root, on_done):
+        self.root = root
+        self.on_done = on_done
+        self.dropped = 0
+        self.completed = 0
+        self._cond = threading.Condition()
+        self._generation = 0
+        self._pending = None     # (generation, job)
+        self._result = None      # (generation, result)
+        self._busy = False
+        self._poll_job = None
+        self._thread = threading.Thread(target=self._worker, name="render", daemon=True)
+        self._thread.start()
+
+    @property
+    def stats(self):
+        return {"completed": self.completed, "dropped": self.dropped}
+
+    def submit(self, job):
+        """job(cancelled) -> result；cancelled() 为真说明已有更新的请求"""
+        with self._cond:
+            self._generation += 1
+            if self._pending: self.dropped += 1
+            self._pending = (self._generation, job)
+            self._cond.notify()
+        if not self._poll_job:
+            self._poll_job = self.root.after(self.POLL_MS, self._poll)
+
+    def cancel(self):
+        """作废所有未完成的请求"""
+        with self._cond:
+            self._generation += 1
+            if self._pending: self.dropped += 1
+            self._pending = None
+
+    def _is_stale(self, generation):
+        return generation != self._generation
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                generation, job = self._pending
+                self._pending = None
+                self._busy = True
+            try:
+                result = job(lambda: self._is_stale(generation))
+            except RenderCancelled:
+                result = None
+                with self._cond: self.dropped += 1
+            except Exception as e:
+                print(f"渲染失败: {e}")
+                result = None
+            with self._cond:
+                self._busy = False
+                if result is not None:
+                    if self._result: self.dropped += 1   # 上一帧还没被主线程取走就已过时
+                    self._result = (generation, result)
+
+    def _poll(self):
+        # 运行在 Tk 主线程
+        self._poll_job = None
+        with self._cond:
+            done, self._result = self._result, None
+            idle = not self._pending and not self._busy
+        if done:
+            generation, result = done
+            if self._is_stale(generation):
+                self.dropped += 1
+            else:
+                self.completed += 1
+                self.on_done(result)
+        if not idle:
+            self._poll_job = self.root.after(self.POLL_MS, self._poll)
+
+
+def render_image(base, params, layer=None, overlays=(), scale=1.0, color_engine=None):
+    """不经缓存的一次性完整渲染，返回新图"""
+    img = RenderPipeline(color_engine).render(base, params, layer, overlays, scale)
+    return img.copy() if img is base else img
+
+
+# ================= 程序化光晕 =================
+# 光晕/漏光/光斑都由渐变图经一次 LUT 映射得到 alpha，只在精灵尺寸上运算，
+# 不再逐个画同心圆、也不落盘。结果按参数放进内存 LRU，拖动时改大小、改颜色都是即时的。
+
+OVERLAY_CACHE_SIZE = 64
+RADIAL_EDGE = 181   # Image.radial_gradient 中心到内切圆边缘的取值 (128 * sqrt(2))
+
+# (名称, 参数)；默认三款与旧版生成的 halo1-3.png 外观一致
+OVERLAY_PRESETS = [
+    ("暖黄光晕", {"kind": "halo", "color": "#ffeb3b", "radius": 100}),
+    ("橙色光晕", {"kind": "halo", "color": "#ff9800", "radius": 125}),
+    ("青色光晕", {"kind": "halo", "color": "#00d2d3", "radius": 90}),
+    ("暖色漏光", {"kind": "leak", "color": "#ff7043", "radius": 220, "falloff": 1.6}),
+    ("横向光斑", {"kind": "flare", "color": "#74b9ff", "radius": 240, "falloff": 2.0}),
+]
+
+
+@functools.lru_cache(maxsize=OVERLAY_CACHE_SIZE)
+def generate_overlay(kind="halo", color="#ffffff", radius=100, falloff=1.0, scale=1.0, strength=100 / 255, core=0.1):
+    """生成 RGBA 光晕精灵 (结果被缓存共享，调用方不得原地修改)
+
+    kind: halo 圆形光晕 / flare 横向光斑 / leak 单侧漏光
+    radius: 半径 (像素，再乘 scale)；falloff: 衰减曲线指数，1 为线性
+    strength: 最大不透明度 (0-1)；core: 白色高光核心占半径的比例
+    """
+    from PIL import ImageChops, ImageColor
+    r = max(2, int(radius * scale))
+    if kind == "flare":
+        size = (2 * r, max(2, r // 6))
+    elif kind == "leak":
+        size = (r, 2 * r)
+    else:
+        size = (2 * r, 2 * r)
+
+    if kind == "leak":
+        # 左缘最亮向右衰减；纵向取一个很宽椭圆的中间一条，得到上下对称的衰减，两者取较大的距离
+        w, h = size
+        across = Image.linear_gradient("L").transpose(Image.Transpose.ROTATE_90).resize(size, Image.Resampling.BILINEAR)
+        along = Image.radial_gradient("L").resize((w * 8, h), Image.Resampling.BILINEAR).crop((w * 4, 0, w * 5, h))
+        dist = ImageChops.lighter(across, along.point(lambda v: min(255, v * 255 // RADIAL_EDGE)))
+        edge, core = 255, 0
+    else:
+        dist = Image.radial_gradient("L").resize(size, Image.Resampling.BILINEAR)
+        edge = RADIAL_EDGE
+
+    # 距离 -> 不透明度：一张 LUT，一次 point
+    lut = []
+    for v in range(256):
+        t = min(1.0, v / edge)
+        a = strength * 255 * (1 - t) ** falloff
+        lut.append(max(int(a), 200) if t < core else int(a))
+    alpha = dist.point(lut)
+
+    rgb = Image.new("RGB", size, ImageColor.getrgb(color)[:3])
+    if core > 0:
+        rgb.paste((255, 255, 255), mask=dist.point(lambda v: 255 if v / edge < core else 0))
+    rgb.putalpha(alpha)
+    return rgb
+
+
+# ---- 滤镜库缩略图 ----
+
+THUMB_SIZE = 100
+THUMB_CELL = (130, 150)      # 网格单元格宽高
+THUMB_MEMORY = 300           # 内存中保留的 PhotoImage 数
+
+
+class ThumbnailCache:
+    """磁盘缩略图缓存，键为 (绝对路径, mtime, 文件大小)；可在任意线程调用 load()"""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if cache_dir:
+            try: os.makedirs(cache_dir, exist_ok=True)
+            except OSError: self.cache_dir = None
+
+    def _cache_path(self, path):
+        st = os.stat(path)
+        key = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".png")
+
+    def load(self, source):
+        """source 为素材路径或程序化光晕参数，返回不超过 THUMB_SIZE 的 RGBA 缩略图"""
+        if isinstance(source, dict):
+            thumb = generate_overlay(**source).copy()
+            thumb.thumbnail((THUMB_SIZE, THUMB_SIZE))
+            return thumb
+
+        cached = self._cache_path(source) if self.cache_dir else None
+        if cached and os.path.exists(cached):
+            try:
+                with Image.open(cached) as im:
+                    return im.convert("RGBA")
+            except Exception:
+                pass # 缓存损坏就重新生成
+
+        with Image.open(source) as im:
+            im.draft("RGB", (THUMB_SIZE, THUMB_SIZE)) # JPEG 按 DCT 缩放解码，其他格式无影响
+            thumb = im.convert("RGBA")
+        thumb.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        if cached:
+            tmp = cached + ".tmp"
+            thumb.save(tmp, "PNG")
+            os.replace(tmp, cached)
+        return thumb
+
+
+class VirtualThumbGrid:
+    """可滚动缩略图网格：只为可见单元格创建控件 (复用一个小控件池)，
+    缩略图在后台线程解码后逐步填入，打开耗时与素材数量无关。"""
+
+    def __init__(self, parent, items, thumbs, on_pick, colors, cols=4):
+        self.items = items          # [(名称, source)]
+        self.thumbs = thumbs
+        self.on_pick = on_pick
+        self.colors = colors
+        self.cols = cols
+        self.cells = []             # 控件池：[(window_id, frame, label, button)]
+        self.photos = OrderedDict() # index -> PhotoImage (LRU)
+        self.futures = {}           # index -> 解码任务
+        self.results = queue.Queue()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumb")
+
+        rows = math.ceil(len(items) / cols)
+        self.canvas = tk.Canvas(parent, bg=colors["bg"], highlightthickness=0)
+        # 占位图：Label 有图时 width/height 按像素算，没图时按字符/行算会把单元格撑大
+        self.blank = tk.PhotoImage(master=self.canvas, width=THUMB_SIZE, height=THUMB_SIZE)
+        bar = tk.Scrollbar(parent, orient=tk.VERTICAL, command=self._on_scrollbar)
+        self.canvas.config(yscrollcommand=bar.set, scrollregion=(0, 0, cols * THUMB_CELL[0], rows * THUMB_CELL[1]))
+        bar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.canvas.bind("<Configure>", lambda e: self.refresh())
+        self.canvas.bind("<MouseWheel>", self._on_wheel)
+        self.canvas.bind("<Destroy>", lambda e: self.close())
+        self.canvas.after(50, self._poll)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _on_scrollbar(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+
+    def _on_wheel(self, event):
+        self.canvas.yview_scroll(-1 if event.delta > 0 else 1, "units")
+        self.refresh()
+
+    def _visible(self):
+        top = self.canvas.canvasy(0)
+        first = max(0, int(top // THUMB_CELL[1]))
+        last = int((top + self.canvas.winfo_height()) // THUMB_CELL[1])
+        return range(first * self.cols, min(len(self.items), (last + 1) * self.cols))
+
+    def _new_cell(self):
+        frame = tk.Frame(self.canvas, bg=self.colors["panel"], padx=5, pady=5)
+        label = tk.Label(frame, image=self.blank, text="…", compound=tk.CENTER, width=THUMB_SIZE, height=THUMB_SIZE,
+                         bg=self.colors["panel"], fg="#888")
+        label.pack()
+        button = tk.Button(frame, bg=self.colors["accent"], fg="white", width=12)
+        button.pack(fill=tk.X, pady=(5, 0))
+        for w in (frame, label): w.bind("<MouseWheel>", self._on_wheel)
+        window_id = self.canvas.create_window(0, 0, anchor=tk.NW, window=frame)
+        return window_id, frame, label, button
+
+    def refresh(self):
+        visible = self._visible()
+        while len(self.cells) < len(visible):
+            self.cells.append(self._new_cell())
+
+        self.shown = {}
+        for cell, idx in zip(self.cells, visible):
+            window_id, frame, label, button = cell
+            name, source = self.items[idx]
+            row, col = divmod(idx, self.cols)
+            self.canvas.coords(window_id, col * THUMB_CELL[0] + 5, row * THUMB_CELL[1] + 5)
+            self.canvas.itemconfigure(window_id, state="normal")
+            button.config(text=f"应用 {name}"[:16], command=lambda src=source: self.on_pick(src))
+            self.shown[idx] = label
+            self._show_thumb(idx, label)
+        for window_id, *_ in self.cells[len(visible):]:
+            self.canvas.itemconfigure(window_id, state="hidden")
+
+        # 滚出视野的解码任务尚未开始的直接取消
+        for idx in [i for i in self.futures if i not in self.shown]:
+            self.futures.pop(idx).cancel()
+
+    def _show_thumb(self, idx, label):
+        photo = self.photos.get(idx)
+        if photo is not None:
+            self.photos.move_to_end(idx)
+            label.config(image=photo, text="", width=THUMB_SIZE, height=THUMB_SIZE)
+            return
+        label.config(image=self.blank, text="…")
+        if idx not in self.futures:
+            self.futures[idx] = self.pool.submit(self._decode, idx)
+
+    def _decode(self, idx):
+        # 后台线程：只做 PIL 解码，PhotoImage 必须在主线程创建
+        try:
+            self.results.put((idx, self.thumbs.load(self.items[idx][1])))
+        except Exception as e:
+            print(f"缩略图生成失败 {self.items[idx][0]}: {e}")
+            self.results.put((idx, None))
+
+    def _poll(self):
+        if not self.canvas.winfo_exists(): return
+        from PIL import ImageTk
+        try:
+            while True:
+                idx, thumb = self.results.get_nowait()
+                self.futures.pop(idx, None)
+                if thumb is None: continue
+                self.photos[idx] = ImageTk.PhotoImage(thumb)
+                while len(self.photos) > THUMB_MEMORY:
+                    self.photos.popitem(last=False)
+                if idx in self.shown:
+                    self._show_thumb(idx, self.shown[idx])
+        except queue.Empty:
+            pass
+        self.canvas.after(50, self._poll)
+
+
+def load_overlay(source):
+    """source 为参数 dict 时程序化生成，为路径时从文件读取"""
+    if isinstance(source, dict):
+        return generate_overlay(**source)
+    return Image.open(source).convert("RGBA")
+
+
+# ================= 光晕合成 =================
+# 光晕栈逐层混合到画面上。每层只处理它与画面相交的矩形，
+# 开销与光晕面积成正比，与画布尺寸无关；完全移出画面的层直接跳过。
+
+BLEND_MODES = {"normal": "正常", "screen": "滤色", "add": "相加"}
+
+OverlayLayer = namedtuple("OverlayLayer", "image pos opacity blend", defaults=(1.0, "normal"))
+
+
+def _overlay_box(size, overlay_size, pos):
+    """光晕中心在 pos 时与画面的相交区域：返回 (画面上的框, 光晕上的框)，不相交返回 None"""
+    (w, h), (ow, oh) = size, overlay_size
+    x0, y0 = math.floor(pos[0] - ow // 2), math.floor(pos[1] - oh // 2)
+    box = (max(0, x0), max(0, y0), min(w, x0 + ow), min(h, y0 + oh))
+    if box[0] >= box[2] or box[1] >= box[3]: return None
+    return box, (box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0)
+
+
+def composite_overlays(img, layers, scale=1.0):
+    """把光晕栈 (OverlayLayer 序列，pos 为原图坐标) 依次混合进 img，原地修改并返回 img"""
+    from PIL import ImageChops
+    for layer in layers:
+        overlay = layer.image
+        if scale != 1.0:
+            ow, oh = overlay.size
+            overlay = overlay.resize((max(1, round(ow * scale)), max(1, round(oh * scale))), Image.Resampling.BILINEAR)
+        boxes = _overlay_box(img.size, overlay.size, (layer.pos[0] * scale, layer.pos[1] * scale))
+        if boxes is None or layer.opacity <= 0: continue
+        box, src_box = boxes
+
+        src = overlay.crop(src_box)
+        alpha = src.getchannel("A")
+        if layer.opacity < 1:
+            alpha = alpha.point([round(a * layer.opacity) for a in range(256)])
+        rgb = src.convert(img.mode)
+        if layer.blend == "normal":
+            img.paste(rgb, box[:2], alpha)
+            continue
+        dst = img.crop(box)
+        mixed = ImageChops.screen(dst, rgb) if layer.blend == "screen" else ImageChops.add(dst, rgb)
+        img.paste(mixed, box[:2], alpha)
+    return img
+
+
+# ================= 快速解码 =================
+# 打开图片分两步：先解码一张不小于画布的预览立即显示，全分辨率在后台解码完再替换。
+# JPEG 用 draft() 让解码器直接按 1/2、1/4、1/8 做 DCT 缩放，其他格式尽量用 EXIF 内嵌缩略图。
+
+
+def _exif_thumbnail(im):
+    """EXIF IFD1 中内嵌的 JPEG 缩略图，没有返回 None"""
+    from PIL import ExifTags
+    import io
+    raw = im.info.get("exif")
+    if not raw: return None
+    try:
+        ifd1 = im.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = ifd1.get(0x0201), ifd1.get(0x0202) # JPEGInterchangeFormat / Length
+        if not offset or not length: return None
+        if raw.startswith(b"Exif\x00\x00"): raw = raw[6:] # 偏移量相对 TIFF 头
+        return Image.open(io.BytesIO(raw[offset:offset + length])).convert("RGB")
+    except Exception:
+        return None
+
+
+def decode_preview(path, target):
+    """返回 (预览图或 None, 原图尺寸)；预览图尽量不小于 target，无法快速得到时为 None"""
+    with Image.open(path) as im:
+        full_size = im.size
+        if im.format == "JPEG":
+            im.draft("RGB", target)
+            if im.size != full_size: return im.convert("RGB"), full_size
+            return None, full_size # 原图本身不比画布大，直接全解码即可
+        thumb = _exif_thumbnail(im)
+        # EXIF 缩略图常是带黑边的 160x120，比例与原图不符时坐标换算会错，宁可等全解码
+        if thumb and abs(thumb.size[1] * full_size[0] - thumb.size[0] * full_size[1]) > full_size[0]: thumb = None
+        return thumb, full_size
+
+
+def decode_full(path):
+    with Image.open(path) as im:
+        return im.convert("RGB")
+
+
+# ================= 导出 =================
+# 导出与预览无关：在后台线程按原图分辨率完整渲染一次，再把同一张结果
+# 并行编码成多个格式/尺寸 (Pillow 编码时释放 GIL，线程池即可并行)。
+
+EXPORT_FORMATS = {   # 格式 -> (扩展名, 默认编码参数)
+    "JPEG": (".jpg", {'quality': 92, 'progressive': False, 'optimize': False}),
+    "PNG": (".png", {'compress_level': 6, 'optimize': False}),
+    "WEBP": (".webp", {'quality': 90, 'method': 4, 'lossless': False}),
+    "GIF": (".gif", {'optimize': False}),
+}
+
+
+def export_format(path):
+    """按扩展名判断导出格式，未知扩展名按 PNG"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".jpeg": return "JPEG"
+    for fmt, (fmt_ext, _) in EXPORT_FORMATS.items():
+        if ext == fmt_ext: return fmt
+    return "PNG"
+
+
+def _resize_for_export(img, scale):
+    if scale == 1.0: return img
+    size = (max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale)))
+    return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+def encode_image(img, path, fmt, options=None, scale=1.0):
+    """按格式和编码参数写文件；先写临时文件再改名，失败时不会留下半个文件"""
+    img = _resize_for_export(img, scale)
+    root, ext = os.path.splitext(path)
+    tmp = root + ".part" + ext
+    img.save(tmp, fmt, **dict(EXPORT_FORMATS[fmt][1], **(options or {})))
+    os.replace(tmp, path)
+
+
+class ExportJob:
+    """一次渲染、多路编码。render() 在调用 run() 的线程里执行并返回全分辨率结果；
+    targets 为 [{'path', 'format', 'options', 'scale'}]"""
+
+    def __init__(self, render, targets, workers=None):
+        self.render = render
+        self.targets = list(targets)
+        self.workers = workers or min(len(self.targets), os.cpu_count() or 1)
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self, progress=None):
+        """progress(已完成步数, 总步数, 说明)；返回 {'written', 'failed': [{file, error}], 'cancelled'}"""
+        total = len(self.targets) + 1
+        report = {'written': [], 'failed': [], 'cancelled': False}
+        if progress: progress(0, total, "渲染")
+        img = self.render()
+        if progress: progress(1, total, "编码")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix="export") as pool:
+            futures = {pool.submit(self._encode, img, t): t for t in self.targets}
+            for n, future in enumerate(concurrent.futures.as_completed(futures), 2):
+                path, err = futures[future]['path'], future.result()
+                if err: report['failed'].append({'file': path, 'error': err})
+                else: report['written'].append(path)
+                if progress: progress(n, total, path)
+        report['cancelled'] = self._cancelled
+        return report
+
+    def _encode(self, img, target):
+        if self._cancelled: return "已取消"
+        try:
+            encode_image(img, target['path'], target['format'], target.get('options'), target.get('scale', 1.0))
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+
+
+# ================= 动画 =================
+# 多帧 GIF / WebP / APNG：帧按需解码，每帧走同一条渲染流水线 (参数、绘画层、光晕都相同)，
+# 线程池按顺序渲染并预编码，写入端逐帧追加到文件。同时在途的帧数有上限，
+# 内存只与线程数有关，与动画长度无关。
+# Pillow 的 save_all 要么要求整个帧列表 (WebP)，要么在内存里攒齐所有帧 (GIF/APNG)，
+# 所以容器由 AnimationWriter 自己写：每帧单独交给 Pillow 编码，再把数据块拼进容器。
+
+ANIMATION_FORMATS = ("GIF", "PNG", "WEBP")   # 能输出动画的格式 (PNG 即 APNG)
+ANIMATION_FRAME_CACHE = 16                   # 预览拖动时保留的已解码帧数
+ANIMATION_DEFAULT_MS = 100                   # 帧里没有时长信息时按 100ms
+
+
+def open_animation(path):
+    """path 是多帧图片时返回 AnimationSource，否则 (或打不开) 返回 None"""
+    try:
+        with Image.open(path) as im:
+            if not getattr(im, "is_animated", False): return None
+            return AnimationSource(path, im)
+    except Exception:
+        return None
+
+
+class AnimationSource:
+    """动图的惰性帧源：打开时只读尺寸和帧数，帧在用到时才解码 (统一转成 RGB，与 decode_full 一致)"""
+
+    def __init__(self, path, im):
+        self.path = path
+        self.size = im.size
+        self.n_frames = im.n_frames
+        self.loop = im.info.get("loop")       # None 表示只播一次
+        self.durations = [None] * self.n_frames # 解码到该帧时填入 (ms)
+        self._cache = OrderedDict()           # 帧号 -> RGB 图 (预览拖动用)
+        self._reader = None                   # 预览用的顺序读取句柄，向后拖动时不必从头 seek
+        self._lock = threading.Lock()
+
+    def _decode(self, im, i):
+        im.seek(i)
+        img = im.convert("RGB")
+        self.durations[i] = im.info.get("duration") or ANIMATION_DEFAULT_MS # WebP 解码后才有时长
+        return img
+
+    def put(self, i, img):
+        """放入已解码好的帧 (打开文件时解码的第 0 帧)，保证同一帧始终是同一个对象，渲染缓存才能命中"""
+        with self._lock:
+            self._cache[i] = img
+            self._cache.move_to_end(i)
+            while len(self._cache) > ANIMATION_FRAME_CACHE: self._cache.popitem(last=False)
+
+    def frame(self, i):
+        """第 i 帧；最近用过的帧直接返回同一个对象"""
+        with self._lock:
+            img = self._cache.get(i)
+            if img is not None:
+                self._cache.move_to_end(i)
+                return img
+            if self._reader is None or self._reader.tell() > i: # GIF/APNG 只能从前往后解
+                if self._reader is not None: self._reader.close()
+                self._reader = Image.open(self.path)
+            img = self._decode(self._reader, i)
+        self.put(i, img)
+        return img
+
+    def frames(self):
+        """按顺序逐帧产出 (RGB 图, 时长 ms)；独立的文件句柄，可在工作线程里用"""
+        with Image.open(self.path) as im:
+            for i in range(self.n_frames):
+                img = self._decode(im, i)
+                yield img, self.durations[i]
+
+    def close(self):
+        with self._lock:
+            if self._reader is not None: self._reader.close()
+            self._reader = None
+            self._cache.clear()
+
+
+def stream_frames(frames, work, workers=None, window=None):
+    """对 frames 中的 (帧, 时长) 在线程池上执行 work(帧)，按原顺序产出 (结果, 时长)；
+    最多 window 帧同时在途，frames 只在有空位时才继续取 (解码)"""
+    workers = workers or os.cpu_count() or 1
+    window = window or workers * 2
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="frames") as pool:
+        pending = deque()
+        try:
+            for frame, duration in frames:
+                pending.append((pool.submit(work, frame), duration))
+                if len(pending) >= window:
+                    future, duration = pending.popleft()
+                    yield future.result(), duration
+            while pending:
+                future, duration = pending.popleft()
+                yield future.result(), duration
+        finally:
+            for future, _ in pending: future.cancel()
+
+
+class AnimationWriter:
+    """逐帧写动图文件：prepare(img) 可在任意线程调用 (量化/编码单帧)，add() 按顺序追加；
+    close() 补全文件尾后把临时文件改名为目标文件，abort() 丢弃临时文件"""
+
+    def __init__(self, path, fmt, n_frames, loop=None, options=None):
+        if fmt not in ANIMATION_FORMATS: raise ValueError(f"{fmt} 不支持动画")
+        self.path, self.fmt, self.n_frames = path, fmt, n_frames
+        self.loop = loop
+        self.size = None  # 画布尺寸取第一帧的 (渲染后的) 尺寸
+        self.options = dict(EXPORT_FORMATS[fmt][1], **(options or {}))
+        root, ext = os.path.splitext(path)
+        self.tmp = root + ".part" + ext
+        self.frames = 0
+        self._seq = 0   # APNG 的 fcTL/fdAT 序号
+        self.fp = open(self.tmp, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None: self.close()
+        else: self.abort()
+
+    def prepare(self, img):
+        """单帧的 (尺寸, 编码结果)：GIF 为量化好的 P 图，PNG/WebP 为单帧文件的字节"""
+        import io
+        if self.fmt == "GIF":
+            return img.size, img.convert("P", palette=Image.Palette.ADAPTIVE)
+        buf = io.BytesIO()
+        img.save(buf, self.fmt, **self.options)
+        return img.size, buf.getvalue()
+
+    def add(self, prepared, duration):
+        size, data = prepared
+        if self.size is None: self.size = size
+        elif size != self.size: raise ValueError(f"帧尺寸 {size} 与第一帧 {self.size} 不同")
+        getattr(self, "_add_" + self.fmt.lower())(data, int(duration))
+        self.frames += 1
+
+    def close(self):
+        getattr(self, "_finish_" + self.fmt.lower())()
+        self.fp.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.fp.close()
+        try: os.remove(self.tmp)
+        except OSError: pass
+
+    # --- GIF：Pillow 的 getheader/getdata 逐帧写，每帧带自己的局部调色板 ---
+
+    def _add_gif(self, im, duration):
+        from PIL import GifImagePlugin
+        if self.frames == 0:
+            info = {'duration': duration}
+            if self.loop is not None: info['loop'] = self.loop
+            header, _ = GifImagePlugin.getheader(im, None, info)
+            self.fp.write(b"".join(header))
+        for chunk in GifImagePlugin.getdata(im, duration=duration, include_color_table=self.frames > 0):
+            self.fp.write(chunk)
+
+    def _finish_gif(self):
+        self.fp.write(b";")
+
+    # --- APNG：IHDR + acTL，每帧 fcTL，首帧保留 IDAT，之后的帧改写成 fdAT ---
+
+    def _png_chunk(self, ctype, data):
+        import zlib
+        self.fp.write(struct.pack(">I", len(data)) + ctype + data + struct.pack(">I", zlib.crc32(ctype + data)))
+
+    def _add_png(self, png, duration):
+        chunks, pos = [], 8
+        while pos < len(png):
+            n, ctype = struct.unpack(">I4s", png[pos:pos + 8])
+            chunks.append((ctype, png[pos + 8:pos + 8 + n]))
+            pos += 12 + n
+        if self.frames == 0:
+            self.fp.write(png[:8])
+            self._png_chunk(b"IHDR", chunks[0][1])
+            self._png_chunk(b"acTL", struct.pack(">II", self.n_frames, self.loop if self.loop is not None else 1))
+        w, h = self.size
+        self._png_chunk(b"fcTL", struct.pack(">IIIIIHHBB", self._seq, w, h, 0, 0, min(duration, 65535), 1000, 0, 0))
+        self._seq += 1
+        for ctype, data in chunks:
+            if ctype != b"IDAT": continue
+            if self.frames == 0:
+                self._png_chunk(b"IDAT", data)
+            else:
+                self._png_chunk(b"fdAT", struct.pack(">I", self._seq) + data)
+                self._seq += 1
+
+    def _finish_png(self):
+        self._png_chunk(b"IEND", b"")
+
+    # --- WebP：VP8X + ANIM，每帧的 VP8/VP8L (及 ALPH) 块包进一个 ANMF；RIFF 长度最后回填 ---
+
+    def _riff_chunk(self, ctype, data):
+        self.fp.write(ctype + struct.pack("<I", len(data)) + data + (b"\0" if len(data) % 2 else b""))
+
+    def _add_webp(self, webp, duration):
+        w, h = self.size
+        if self.frames == 0:
+            self.fp.write(b"RIFF\0\0\0\0WEBP")
+            self._riff_chunk(b"VP8X", bytes([0x02, 0, 0, 0]) + (w - 1).to_bytes(3, "little") + (h - 1).to_bytes(3, "little"))
+            self._riff_chunk(b"ANIM", bytes(4) + struct.pack("<H", self.loop if self.loop is not None else 1))
+        payload, pos = [], 12
+        while pos < len(webp):
+            ctype, n = webp[pos:pos + 4], struct.unpack("<I", webp[pos + 4:pos + 8])[0]
+            if ctype in (b"ALPH", b"VP8 ", b"VP8L"): payload.append(webp[pos:pos + 8 + n + n % 2])
+            pos += 8 + n + n % 2
+        header = bytes(6) + (w - 1).to_bytes(3, "little") + (h - 1).to_bytes(3, "little") + \
+            min(duration, 0xFFFFFF).to_bytes(3, "little") + bytes([0x02]) # 不与上一帧混合
+        self._riff_chunk(b"ANMF", header + b"".join(payload))
+
+    def _finish_webp(self):
+        self.fp.seek(0, os.SEEK_END)
+        size = self.fp.tell()
+        self.fp.seek(4)
+        self.fp.write(struct.pack("<I", size - 8))
+
+
+class AnimationExportJob:
+    """动图导出，接口同 ExportJob：帧按顺序解码，render(帧) 和各目标的单帧编码在线程池上并行，
+    结果按原顺序和原时长逐帧写入各目标文件。不支持动画的格式 (JPEG) 只输出第一帧"""
+
+    def __init__(self, source, render, targets, workers=None):
+        self.source = source
+        self.render = render
+        self.targets = list(targets)
+        self.workers = workers or os.cpu_count() or 1
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def _work(self, writers, frame):
+        img = self.render(frame)
+        return [w.prepare(_resize_for_export(img, scale)) for w, scale in writers]
+
+    def run(self, progress=None):
+        total = self.source.n_frames
+        report = {'written': [], 'failed': [], 'cancelled': False}
+        writers, stills = [], []
+        for t in self.targets:
+            if t['format'] not in ANIMATION_FORMATS:
+                stills.append(t)
+                continue
+            scale = t.get('scale', 1.0)
+            try:
+                writers.append((AnimationWriter(t['path'], t['format'], total, self.source.loop, t.get('options')), scale))
+            except Exception as e:
+                report['failed'].append({'file': t['path'], 'error': f"{type(e).__name__}: {e}"})
+
+        try:
+            frames = stream_frames(self.source.frames(), functools.partial(self._work, writers), self.workers)
+            for n, (encoded, duration) in enumerate(frames, 1):
+                if self._cancelled: break
+                if n == 1:
+                    for t in stills: self._write_still(t, report)
+                for (writer, _), data in zip(writers, encoded): writer.add(data, duration)
+                if progress: progress(n, total, f"第 {n} 帧")
+            frames.close()
+        except Exception as e:
+            for writer, _ in writers: writer.abort()
+            report['failed'] += [{'file': w.path, 'error': f"{type(e).__name__}: {e}"} for w, _ in writers]
+            return report
+
+        for writer, _ in writers:
+            if self._cancelled:
+                writer.abort()
+                continue
+            try:
+                writer.close()
+                report['written'].append(writer.path)
+            except Exception as e:
+                writer.abort()
+                report['failed'].append({'file': writer.path, 'error': f"{type(e).__name__}: {e}"})
+        report['cancelled'] = self._cancelled
+        return report
+
+    def _write_still(self, target, report):
+        try:
+            img = self.render(self.source.frame(0))
+            encode_image(img, target['path'], target['format'], target.get('options'), target.get('scale', 1.0))
+            report['written'].append(target['path'])
+        except Exception as e:
+            report['failed'].append({'file': target['path'], 'error': f"{type(e).__name__}: {e}"})
+
+
+# ================= 批量处理 =================
+# 把一份"配方" (params + 可选光晕 + 可选裁剪) 应用到整个目录树。
+# 文件边遍历边提交到进程池，同时在途的任务数有上限，内存占用与目录大小无关。
+# 该部分不依赖 Tk，命令行模式 (python demo.py --batch ...) 可在无显示环境运行。
+
+BATCH_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff")
+BATCH_REPORT = "batch_report.json"
+
+
+def make_recipe(params, overlays=(), crop=None):
+    """配方：overlays 为 [{'source', 'pos', 'opacity', 'blend'}]，source 为素材路径或程序化光晕参数；
+    pos / crop 用相对于整幅原图的坐标 (0-1)，以便套用到不同尺寸的图片"""
+    return {
+        'params': dict(params, crop=None), # 像素坐标的裁剪不通用，改存在 'crop' 中
+        'overlays': [dict(o, pos=list(o['pos'])) for o in overlays],
+        'crop': list(crop) if crop else None,
+    }
+
+
+def recipe_overlays(recipe):
+    """配方中的光晕列表；兼容旧版只有单个 'overlay' (来源键为 'path' 或 'source') 的配方"""
+    if 'overlays' in recipe: return recipe['overlays'] or []
+    old = recipe.get('overlay')
+    return [{'source': old.get('source', old.get('path')), 'pos': old['pos']}] if old else []
+
+
+def iter_batch_files(src_dir):
+    """按目录树顺序逐个产出相对路径 (不一次性列出全部文件)"""
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(BATCH_EXTS):
+                yield os.path.relpath(os.path.join(dirpath, name), src_dir)
+
+
+_batch_recipe = None
+_batch_overlays = None
+
+
+def _batch_worker_init(recipe, threads=None):
+    # 每个工作进程只解析一次配方、读一次光晕素材；threads 为进程内锐化/模糊的分块线程数
+    global _batch_recipe, _batch_overlays, _shared_filter
+    _batch_recipe = recipe
+    _batch_overlays = [load_overlay(o['source']) for o in recipe_overlays(recipe)]
+    _shared_filter = TiledFilter(threads)
+
+
+def apply_recipe(img, recipe, overlay_images=None):
+    """对一张 RGB 图执行配方，返回新图；overlay_images 为预先读好的光晕图 (与配方中的光晕一一对应)"""
+    params, crop = recipe['params'], recipe.get('crop')
+    w, h = img.size
+    if crop: # 裁剪作为渲染参数，只处理保留区域
+        params = dict(params, crop=(round(crop[0] * w), round(crop[1] * h), round(crop[2] * w), round(crop[3] * h)))
+    specs = recipe_overlays(recipe)
+    if overlay_images is None:
+        overlay_images = [load_overlay(o['source']) for o in specs]
+    overlays = [OverlayLayer(im, (o['pos'][0] * w, o['pos'][1] * h), o.get('opacity', 1.0), o.get('blend', "normal"))
+                for im, o in zip(overlay_images, specs)]
+    return render_image(img, params, None, overlays)
+
+
+def _batch_process_file(src, dst):
+    """工作进程中处理单个文件，返回 (src, 错误信息或 None)"""
+    try:
+        with Image.open(src) as im:
+            img = im.convert("RGB")
+        out = apply_recipe(img, _batch_recipe, _batch_overlays)
+        os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+        # 先写临时文件再改名，中断时不会留下被当成"已完成"的半个文件
+        root, ext = os.path.splitext(dst)
+        tmp = root + ".part" + ext
+        out.save(tmp)
+        os.replace(tmp, dst)
+        return src, None
+    except Exception as e:
+        return src, f"{type(e).__name__}: {e}"
+
+
+class BatchProcessor:
+    """进程池批处理：流式提交、进度回调、可取消、跳过已完成文件、逐文件错误报告
+    threads 为每个进程内滤镜的分块线程数，默认把 CPU 核数平分给各进程 (进程少、图大时仍能吃满多核)"""
+
+    def __init__(self, src_dir, dst_dir, recipe, workers=None, out_ext=None, skip_done=True, threads=None):
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.recipe = recipe
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads or max(1, (os.cpu_count() or 1) // self.workers)
+        self.out_ext = out_ext          # 如 ".jpg"；None 表示保持原格式
+        self.skip_done = skip_done
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def _dst_for(self, rel):
+        if self.out_ext:
+            rel = os.path.splitext(rel)[0] + self.out_ext
+        return os.path.join(self.dst_dir, rel)
+
+    def _is_done(self, src, dst):
+        return os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src)
+
+    def run(self, progress=None):
+        """progress(已处理数, 总数, 当前文件) 在调用线程中回调；返回报告 dict 并写入 BATCH_REPORT"""
+        files = list(iter_batch_files(self.src_dir)) # 只遍历一次目录，总数与实际处理的列表一致
+        total = len(files)
+        report = {'total': total, 'done': 0, 'skipped': 0, 'failed': [], 'cancelled': False}
+        finished = 0
+        max_pending = self.workers * 2
+
+        with concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_batch_worker_init,
+                                                    initargs=(self.recipe, self.threads)) as pool:
+            pending = set()
+
+            def drain(block):
+                nonlocal finished
+                if not pending: return
+                done, _ = concurrent.futures.wait(
+                    pending, timeout=None if block else 0, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    pending.discard(fut)
+                    src, err = fut.result()
+                    if err: report['failed'].append({'file': src, 'error': err})
+                    else: report['done'] += 1
+                    finished += 1
+                    if progress: progress(finished, total, src)
+
+            for rel in files:
+                if self.cancel_event.is_set(): break
+                src, dst = os.path.join(self.src_dir, rel), self._dst_for(rel)
+                if self.skip_done and self._is_done(src, dst):
+                    report['skipped'] += 1
+                    finished += 1
+                    if progress: progress(finished, total, src)
+                    continue
+                pending.add(pool.submit(_batch_process_file, src, dst))
+                if len(pending) >= max_pending: drain(block=True)
+                else: drain(block=False)
+
+            if self.cancel_event.is_set():
+                report['cancelled'] = True
+                for fut in pending: fut.cancel()
+                pending = {f for f in pending if not f.cancelled()}
+            while pending: drain(block=True)
+
+        os.makedirs(self.dst_dir, exist_ok=True)
+        with open(os.path.join(self.dst_dir, BATCH_REPORT), "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return report
+
+
+def run_batch_cli(argv):
+    """命令行批处理入口，不创建 Tk 窗口"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="demo.py --batch", description="LitePixel 批量处理")
+    parser.add_argument("src", help="输入目录")
+    parser.add_argument("dst", help="输出目录")
+    parser.add_argument("--recipe", help="配方 JSON (界面中“保存配方”导出)")
+    parser.add_argument("--format", dest="out_ext", help="输出扩展名，如 .jpg；默认保持原格式")
+    parser.add_argument("--workers", type=int, default=None, help="进程数，默认 CPU 核数")
+    parser.add_argument("--threads", type=int, default=None, help="每个进程内锐化/模糊的线程数，默认 CPU 核数 / 进程数")
+    parser.add_argument("--no-skip", action="store_true", help="不跳过已处理过的文件")
+    args = parser.parse_args(argv)
+
+    params = {'brightness': 1.0, 'contrast': 1.0, 'saturation': 1.0, 'sharpness': 1.0,
+              'blur': 0, 'rotate': 0, 'flip_h': False, 'flip_v': False, 'angle': 0.0, 'crop': None}
+    recipe = make_recipe(params)
+    if args.recipe:
+        with open(args.recipe, encoding="utf-8") as f:
+            loaded = json.load(f)
+        params.update(loaded.get('params', {}))
+        recipe.update(loaded, params=params)
+
+    out_ext = args.out_ext
+    if out_ext and not out_ext.startswith("."): out_ext = "." + out_ext
+
+    def progress(n, total, path):
+        print(f"[{n}/{total}] {path}", flush=True)
+
+    processor = BatchProcessor(args.src, args.dst, recipe, args.workers, out_ext, not args.no_skip, args.threads)
+    try:
+        report = processor.run(progress)
+    except KeyboardInterrupt:
+        processor.cancel()
+        return 130
+    print(f"完成 {report['done']}，跳过 {report['skipped']}，失败 {len(report['failed'])}")
+    for item in report['failed']:
+        print(f"  {item['file']}: {item['error']}")
+    return 1 if report['failed'] else 0
+
+
+# ================= 目录浏览 =================
+# 同目录上一张/下一张：相邻文件在后台线程池上提前解码进 LRU 缓存 (按字节预算)，
+# 切换到已预取的文件不需要任何解码。缓存键含 mtime 和文件大小，文件被改写后会重新解码。
+
+PREFETCH_BUDGET_BYTES = 1024 * 1024 * 1024   # 已解码图片缓存的内存预算
+PREFETCH_AHEAD = 2                           # 沿浏览方向预取几张
+PREFETCH_BEHIND = 1                          # 反方向预取几张
+EDIT_STATE_BUDGET_BYTES = 256 * 1024 * 1024  # 离开文件时保留的绘画层的内存预算
+
+
+def folder_images(folder):
+    """目录中的图片文件 (绝对路径，按文件名不区分大小写排序)"""
+    with os.scandir(folder) as it:
+        names = [e.name for e in it if e.is_file() and e.name.lower().endswith(BATCH_EXTS)]
+    return [os.path.join(folder, n) for n in sorted(names, key=str.lower)]
+
+
+class DecodeCache:
+    """全分辨率解码结果的 LRU 缓存 + 后台预取；同一文件同时只解码一次"""
+
+    def __init__(self, budget=PREFETCH_BUDGET_BYTES, workers=2):
+        self.budget = budget
+        self.workers = workers
+        self.nbytes = 0
+        self._items = OrderedDict()   # (绝对路径, mtime_ns, 文件大小) -> 图
+        self._pending = {}            # 同上 -> Future
+        self._lock = threading.RLock() # Future 的回调可能在持锁时同步触发
+        self._pool = None
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+    def get(self, path):
+        """已解码好的图，没有返回 None"""
+        try: key = self._key(path)
+        except OSError: return None
+        with self._lock:
+            img = self._items.get(key)
+            if img is not None: self._items.move_to_end(key)
+            return img
+
+    def pending(self, path):
+        """正在解码 path 的 Future，没有返回 None"""
+        try: key = self._key(path)
+        except OSError: return None
+        with self._lock:
+            return self._pending.get(key)
+
+    def request(self, path):
+        """返回解码 path 的 Future；已缓存或正在解码时复用"""
+        key = self._key(path)
+        with self._lock:
+            img = self._items.get(key)
+            if img is not None:
+                self._items.move_to_end(key)
+                fut = concurrent.futures.Future()
+                fut.set_result(img)
+                return fut
+            fut = self._pending.get(key)
+            if fut is None:
+                if self._pool is None:
+                    self._pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="prefetch")
+                fut = self._pending[key] = self._pool.submit(decode_full, path)
+                fut.add_done_callback(lambda f, key=key: self._done(key, f))
+            return fut
+
+    def _done(self, key, fut):
+        with self._lock:
+            if self._pending.get(key) is fut: del self._pending[key]
+            if fut.cancelled() or fut.exception() is not None: return
+            img = fut.result()
+            if key in self._items: return
+            self._items[key] = img
+            self.nbytes += _image_nbytes(img)
+            while self.nbytes > self.budget and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self.nbytes -= _image_nbytes(old)
+
+    def prefetch(self, paths):
+        """按优先级排队 paths；排队中但不在 paths 里的旧预取取消掉，让当前要看的图先解码"""
+        keys = {}
+        for path in paths:
+            try: keys[self._key(path)] = path
+            except OSError: pass
+        with self._lock:
+            for key, fut in list(self._pending.items()):
+                if key not in keys: fut.cancel()
+        for path in keys.values():
+            try: self.request(path)
+            except OSError: pass
+
+
+# ================= 绘画层 =================
+# 绘画层按 256x256 瓦片稀疏存储：只有画笔/橡皮/马赛克真正写到的瓦片才分配内存，
+# 合成、裁剪、历史和导出都只遍历已分配的瓦片，没画过的图层几乎不占内存也不耗时。
+# 历史记录使用同一套瓦片网格，撤销时直接交换瓦片对象。
+
+LAYER_TILE = 256
+
+
+def _intersect(a, b):
+    box = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    return box if box[0] < box[2] and box[1] < box[3] else None
+
+
+class TiledLayer:
+    """稀疏瓦片的 RGBA 图层，接口取 PIL.Image 的子集 (size / mode / crop / paste / getbbox / copy)"""
+
+    mode = "RGBA"
+
+    def __init__(self, size):
+        self.size = tuple(size)
+        self.tiles = {}     # (tx, ty) -> RGBA 瓦片，图像边缘的瓦片按边界截断
+        self.bbox = None    # 写入过的区域的外接矩形 (保守：擦除后不收缩，精确值用 getbbox)
+
+    @property
+    def nbytes(self):
+        return sum(_image_nbytes(t) for t in self.tiles.values())
+
+    def keys(self, rect):
+        """rect 覆盖到的瓦片坐标 (不论是否已分配)"""
+        w, h = self.size
+        x0, y0 = max(0, int(rect[0])), max(0, int(rect[1]))
+        x1, y1 = min(w, math.ceil(rect[2])), min(h, math.ceil(rect[3]))
+        if x0 >= x1 or y0 >= y1: return []
+        return [(tx, ty) for ty in range(y0 // LAYER_TILE, (y1 - 1) // LAYER_TILE + 1)
+                for tx in range(x0 // LAYER_TILE, (x1 - 1) // LAYER_TILE + 1)]
+
+    def tile_box(self, key):
+        x0, y0 = key[0] * LAYER_TILE, key[1] * LAYER_TILE
+        return (x0, y0, min(self.size[0], x0 + LAYER_TILE), min(self.size[1], y0 + LAYER_TILE))
+
+    def get_tile(self, key):
+        return self.tiles.get(key)
+
+    def set_tile(self, key, tile):
+        """放入 (或以 None 移除) 一块瓦片，对象直接归图层所有 (撤销/重做交换瓦片用)"""
+        if tile is None:
+            self.tiles.pop(key, None)
+        else:
+            self.tiles[key] = tile
+            self._grow(self.tile_box(key))
+
+    def _tile(self, key, create):
+        tile = self.tiles.get(key)
+        if tile is None and create:
+            x0, y0, x1, y1 = self.tile_box(key)
+            tile = self.tiles[key] = Image.new("RGBA", (x1 - x0, y1 - y0), (0, 0, 0, 0))
+        return tile
+
+    def _grow(self, rect):
+        b = self.bbox
+        self.bbox = tuple(rect) if b is None else (min(b[0], rect[0]), min(b[1], rect[1]), max(b[2], rect[2]), max(b[3], rect[3]))
+
+    def _visit(self, box):
+        """box 内的已分配瓦片：(瓦片, 瓦片框, 与 box 的交集)"""
+        for key, tile in list(self.tiles.items()):
+            tb = self.tile_box(key)
+            part = _intersect(tb, box)
+            if part: yield tile, tb, part
+
+    def getbbox(self):
+        """非透明像素的外接矩形 (同 Image.getbbox)，只看已分配的瓦片"""
+        box = None
+        for key, tile in list(self.tiles.items()):
+            b = tile.getbbox()
+            if not b: continue
+            x0, y0 = key[0] * LAYER_TILE, key[1] * LAYER_TILE
+            b = (b[0] + x0, b[1] + y0, b[2] + x0, b[3] + y0)
+            box = b if box is None else (min(box[0], b[0]), min(box[1], b[1]), max(box[2], b[2]), max(box[3], b[3]))
+        return box
+
+    def is_empty(self, box=None):
+        """box (默认整层) 内一定没有内容"""
+        return self.bbox is None or (box is not None and _intersect(self.bbox, box) is None)
+
+    def copy(self):
+        layer = TiledLayer(self.size)
+        layer.tiles = {key: tile.copy() for key, tile in self.tiles.items()}
+        layer.bbox = self.bbox
+        return layer
+
+    def crop(self, box):
+        """box 区域拼成一张 RGBA 图，未分配处透明"""
+        box = tuple(box)
+        out = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]), (0, 0, 0, 0))
+        for tile, tb, part in self._visit(box):
+            out.paste(tile.crop((part[0] - tb[0], part[1] - tb[1], part[2] - tb[0], part[3] - tb[1])),
+                      (part[0] - box[0], part[1] - box[1]))
+        return out
+
+    def paste(self, im, xy, mask=None):
+        """同 Image.paste(im, xy, mask)；掩码全空的瓦片不会被分配"""
+        x0, y0 = xy
+        rect = (x0, y0, x0 + im.size[0], y0 + im.size[1])
+        for key in self.keys(rect):
+            tb = self.tile_box(key)
+            part = _intersect(tb, rect)
+            src = (part[0] - x0, part[1] - y0, part[2] - x0, part[3] - y0)
+            m = mask.crop(src) if mask is not None else None
+            if m is not None and not m.getbbox(): continue
+            self._tile(key, True).paste(im.crop(src), (part[0] - tb[0], part[1] - tb[1]), m)
+            self._grow(part)
+
+    def ellipse(self, xy, fill):
+        """在各相关瓦片上画实心椭圆 (坐标按瓦片原点平移)；填透明 (橡皮) 时不分配新瓦片"""
+        from PIL import ImageDraw
+        erase = fill[3] == 0
+        xy = tuple(int(v) for v in xy) # ImageDraw 内部也是截断取整；先在整层坐标上取整，平移后逐像素一致
+        rect = (xy[0], xy[1], xy[2] + 1, xy[3] + 1)
+        for key in self.keys(rect):
+            tile = self._tile(key, not erase)
+            if tile is None: continue
+            ox, oy = key[0] * LAYER_TILE, key[1] * LAYER_TILE
+            ImageDraw.Draw(tile).ellipse((xy[0] - ox, xy[1] - oy, xy[2] - ox, xy[3] - oy), fill=fill)
+            if not erase: self._grow(_intersect(self.tile_box(key), rect))
+
+    def composite(self, img, box=None):
+        """把图层 box 区域 (默认整层) 按 alpha 叠到 img 上 (img 与 box 同尺寸)，原地修改并返回 img"""
+        box = tuple(box) if box else (0, 0) + self.size
+        for tile, tb, part in self._visit(box):
+            if part != tb: tile = tile.crop((part[0] - tb[0], part[1] - tb[1], part[2] - tb[0], part[3] - tb[1]))
+            img.paste(tile, (part[0] - box[0], part[1] - box[1]), tile)
+        return img
+
+    def resize(self, size, resample, box=None):
+        """同 Image.resize(size, resample, box)，只重采样有内容的部分；box 内没有内容时返回 None"""
+        box = tuple(box) if box else (0, 0) + self.size
+        if self.is_empty(box): return None
+        sx, sy = size[0] / (box[2] - box[0]), size[1] / (box[3] - box[1])
+        # 内容区换算到输出像素 (外扩重采样核的半径)，再按输出像素网格反推源区域，结果与整层缩放一致
+        pad = 2
+        b = _intersect(self.bbox, box)
+        dst = (max(0, math.floor((b[0] - box[0]) * sx) - pad), max(0, math.floor((b[1] - box[1]) * sy) - pad),
+               min(size[0], math.ceil((b[2] - box[0]) * sx) + pad), min(size[1], math.ceil((b[3] - box[1]) * sy) + pad))
+        src = (box[0] + dst[0] / sx, box[1] + dst[1] / sy, box[0] + dst[2] / sx, box[1] + dst[3] / sy)
+        margin = math.ceil(max(2, 2 / sx, 2 / sy))
+        region = (max(0, math.floor(src[0]) - margin), max(0, math.floor(src[1]) - margin),
+                  min(self.size[0], math.ceil(src[2]) + margin), min(self.size[1], math.ceil(src[3]) + margin))
+        part = self.crop(region).resize((dst[2] - dst[0], dst[3] - dst[1]), resample,
+                                        box=(src[0] - region[0], src[1] - region[1], src[2] - region[0], src[3] - region[1]))
+        out = Image.new("RGBA", size, (0, 0, 0, 0))
+        out.paste(part, dst[:2])
+        return out
+
+
+def _layer_empty(layer, box=None):
+    return isinstance(layer, TiledLayer) and layer.is_empty(box)
+
+
+def composite_layer(img, layer, box=None):
+    """把绘画层 (TiledLayer 或 RGBA 图) 的 box 区域按 alpha 叠到 img 上，原地修改并返回 img"""
+    if isinstance(layer, TiledLayer): return layer.composite(img, box)
+    part = layer.crop(box) if box else layer
+    img.paste(part, (0, 0), part)
+    return img
+
+
+# ================= 笔刷引擎 =================
+# 画笔和橡皮都沿轨迹按固定间距盖圆形笔印 (dab)，只改写笔印覆盖的那块绘画层，
+# 每段返回脏矩形，调用方据此只刷新这一块预览，长笔画在大图上也不会越画越慢。
+
+STROKE_SPACING = 0.25    # 相邻笔印的间距，相对笔刷直径
+
+
+class StrokeEngine:
+    """一笔的状态：上一个点、距下一个笔印还差的距离、整笔的脏矩形"""
+
+    def __init__(self, spacing=STROKE_SPACING):
+        self.spacing = spacing
+        self.layer = None
+        self.dirty = None
+
+    def begin(self, layer, size, color, erase=False, before_draw=None):
+        """开始一笔；橡皮把 alpha 清零。before_draw(rect) 在图层 rect 区域被改写前调用 (用来记历史)"""
+        self.layer = layer
+        self.size = max(1, size)
+        self.fill = (0, 0, 0, 0) if erase else color # ImageDraw 直接写像素，不与原内容混合；橡皮不分配新瓦片
+        self.before_draw = before_draw
+        self.last = None
+        self.travelled = 0.0   # 上一个笔印之后走过的距离
+        self.dirty = None
+
+    def stroke_to(self, x, y):
+        """从上一点画到 (x, y)，返回这一段的脏矩形 (整数，已裁到图层内)；没有改动返回 None"""
+        dabs = [(x, y)] if self.last is None else self._interpolate(self.last, (x, y))
+        self.last = (x, y)
+        if not dabs: return None
+
+        r = self.size / 2
+        xs, ys = [p[0] for p in dabs], [p[1] for p in dabs]
+        w, h = self.layer.size
+        rect = (max(0, math.floor(min(xs) - r)), max(0, math.floor(min(ys) - r)),
+                min(w, math.ceil(max(xs) + r) + 1), min(h, math.ceil(max(ys) + r) + 1))
+        if rect[0] >= rect[2] or rect[1] >= rect[3]: return None
+
+        if self.before_draw: self.before_draw(rect)
+        for px, py in dabs:
+            self.layer.ellipse((px - r, py - r, px + r, py + r), self.fill)
+        d = self.dirty
+        self.dirty = rect if d is None else (min(d[0], rect[0]), min(d[1], rect[1]), max(d[2], rect[2]), max(d[3], rect[3]))
+        return rect
+
+    def _interpolate(self, p0, p1):
+        step = max(1.0, self.size * self.spacing)
+        dist = math.hypot(p1[0] - p0[0], p1[1] - p0[1])
+        t = step - self.travelled
+        dabs = []
+        while t <= dist:
+            k = t / dist
+            dabs.append((p0[0] + (p1[0] - p0[0]) * k, p0[1] + (p1[1] - p0[1]) * k))
+            t += step
+        self.travelled = dist - (t - step) if dabs else self.travelled + dist
+        return dabs
+
+
+# ---- 马赛克 ----
+# 马赛克在原图坐标上按固定网格分块，每块取原图均值写进绘画层。
+# 一次把所有新块的外接矩形交给 reduce(块大小) 求均值 (C 实现，每块一个像素)，
+# 再最近邻放大回去按掩码贴上，同一笔里已处理过的块不再重复计算。
+
+def mosaic_cells(p0, p1, radius, size, image_size):
+    """从 p0 到 p1、半径 radius 的笔迹经过的网格块 (块坐标集合)"""
+    cols, rows = math.ceil(image_size[0] / size), math.ceil(image_size[1] / size)
+    dist = math.hypot(p1[0] - p0[0], p1[1] - p0[1])
+    steps = max(1, math.ceil(dist / max(1.0, min(size, radius * 2) / 2)))
+    cells = set()
+    for i in range(steps + 1):
+        x = p0[0] + (p1[0] - p0[0]) * i / steps
+        y = p0[1] + (p1[1] - p0[1]) * i / steps
+        for by in range(max(0, math.floor((y - radius) / size)), min(rows, math.floor((y + radius) / size) + 1)):
+            for bx in range(max(0, math.floor((x - radius) / size)), min(cols, math.floor((x + radius) / size) + 1)):
+                cells.add((bx, by))
+    return cells
+
+
+def apply_mosaic(src, layer, cells, size):
+    """把 cells 中每块的 src 均值色写进 layer (TiledLayer，与 src 同尺寸)，返回改动的矩形"""
+    bx0, by0 = min(c[0] for c in cells), min(c[1] for c in cells)
+    bx1, by1 = max(c[0] for c in cells) + 1, max(c[1] for c in cells) + 1
+    w, h = src.size
+    rect = (bx0 * size, by0 * size, min(w, bx1 * size), min(h, by1 * size))
+    rw, rh = rect[2] - rect[0], rect[3] - rect[1]
+
+    means = src.crop(rect).reduce(size) # 边缘不足一块的只对实际像素求均值
+    mask = Image.new("L", means.size, 0)
+    for bx, by in cells: mask.putpixel((bx - bx0, by - by0), 255)
+    full = (means.size[0] * size, means.size[1] * size)
+    blocks = means.convert("RGBA").resize(full, Image.Resampling.NEAREST).crop((0, 0, rw, rh))
+    mask = mask.resize(full, Image.Resampling.NEAREST).crop((0, 0, rw, rh))
+    layer.paste(blocks, rect[:2], mask)
+    return rect
+
+
+# ================= 历史记录 =================
+# 每条记录只存参数和对象引用；绘画层在原地修改前，由调用方通过 record()
+# 把将被改动的瓦片复制进栈顶记录 (写时复制)，未改动的像素在各记录之间共享。
+# 瓦片网格就是 TiledLayer 的网格：未分配的瓦片记为 None，不占内存。
+
+HISTORY_BUDGET_BYTES = 256 * 1024 * 1024   # 撤销/重做栈的内存预算
+
+
+class HistoryEntry:
+    def __init__(self, state):
+        self.state = state    # params / overlay / 图像与图层的引用
+        self.layer = None     # tiles 所属的图层对象
+        self.tiles = {}       # (tx, ty) -> 改动前的瓦片 (None 表示当时未分配)
+        self.nbytes = 0
+
+
+class HistoryManager:
+    """参数快照 + 瓦片差分的撤销/重做栈，超出字节预算时丢弃最旧的记录"""
+
+    def __init__(self, budget_bytes=HISTORY_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self.undo_stack = []
+        self.redo_stack = []
+        self._live = ()       # 当前正在使用的图像对象，不计入历史占用
+
+    def clear(self):
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def push(self, state):
+        """记录一次编辑前的状态；新的编辑会清空重做栈"""
+        self.undo_stack.append(HistoryEntry(state))
+        self.redo_stack = []
+        self._set_live(state)
+        self._trim()
+
+    def record(self, layer, rect):
+        """layer 的 rect 区域即将被原地修改：把其中尚未保存的瓦片复制进栈顶记录"""
+        if not self.undo_stack: return
+        entry = self.undo_stack[-1]
+        if entry.layer is None: entry.layer = layer
+        elif entry.layer is not layer: return
+        for key in layer.keys(rect):
+            if key not in entry.tiles:
+                tile = layer.get_tile(key)
+                entry.tiles[key] = tile.copy() if tile is not None else None
+                if tile is not None: entry.nbytes += _image_nbytes(tile)
+        self._trim()
+
+    def undo(self, current_state):
+        """返回需要恢复的状态；current_state 连同被撤销瓦片的当前内容进入重做栈"""
+        if not self.undo_stack: return None
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(self._swap(entry, current_state))
+        self._set_live(entry.state)
+        return entry.state
+
+    def redo(self, current_state):
+        if not self.redo_stack: return None
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(self._swap(entry, current_state))
+        self._set_live(entry.state)
+        return entry.state
+
+    def _set_live(self, state):
+        self._live = tuple(state.get(k) for k in ('image', 'layer'))
+
+    def _swap(self, entry, current_state):
+        # 把 entry 的瓦片放回图层，被换下的瓦片对象进入反向记录 (不复制像素)
+        reverse = HistoryEntry(current_state)
+        reverse.layer = entry.layer
+        for key, tile in entry.tiles.items():
+            old = entry.layer.get_tile(key)
+            reverse.tiles[key] = old
+            if old is not None: reverse.nbytes += _image_nbytes(old)
+            entry.layer.set_tile(key, tile)
+        return reverse
+
+    @property
+    def nbytes(self):
+        """瓦片占用 + 只被历史引用的整图 (如裁剪前的原图)"""
+        entries = self.undo_stack + self.redo_stack
+        total = sum(e.nbytes for e in entries)
+        held = {}
+        for e in entries:
+            for k in ('image', 'layer'):
+                obj = e.state.get(k)
+                if obj is not None and not any(obj is live for live in self._live):
+                    held[id(obj)] = obj
+        return total + sum(obj.nbytes if isinstance(obj, TiledLayer) else _image_nbytes(obj) for obj in held.values())
+
+    def _trim(self):
+        # 至少保留栈顶记录，否则正在进行的编辑无法撤销
+        while self.nbytes > self.budget_bytes and len(self.undo_stack) > 1:
+            self.undo_stack.pop(0)
+        while self.nbytes > self.budget_bytes and self.redo_stack:
+            self.redo_stack.pop(0)
+
+
+# ================= 视口渲染 =================
+# 画布只显示缩放后图像的一小块。按显示坐标切成固定大小的瓦片，
+# 每块从 mip-map 金字塔中最接近的一级重采样，成本只和画布尺寸有关。
+
+CANVAS_BG = "#282828"
+HIST_PANEL_HEIGHT = 80
+VIEW_TILE = 256      # 瓦片边长 (显示像素)
+VIEW_MARGIN = 128    # 可见区外预先渲染的边距，平移时少量移动不必补瓦片
+
+
+class ViewportRenderer:
+    """mip-map 金字塔 + 按缩放比缓存的显示瓦片"""
+
+    def __init__(self, max_tiles=512):
+        self.max_tiles = max_tiles
+        self._src = None
+        self._levels = []
+        self._display_size = (0, 0)
+        self._tiles = OrderedDict()   # (scale, method, tx, ty) -> tile
+
+    def set_image(self, img):
+        if img is not self._src:
+            self._src = img
+            self._levels = [img]
+            self._tiles.clear()
+
+    def adopt(self, img):
+        """换成内容相同的另一张图 (显示图写时复制后)，保留已生成的金字塔和瓦片"""
+        self._src = img
+        if self._levels: self._levels[0] = img
+
+    def update(self, box, patch):
+        """把 patch 贴到源图 box 处，并只更新受影响的金字塔区域和瓦片"""
+        self._src.paste(patch, box[:2])
+        x0, y0, x1, y1 = box
+        for n in range(1, len(self._levels)):
+            # 上一级按 2 对齐后 reduce，与整幅 reduce(2) 的结果逐像素一致
+            x0, y0, x1, y1 = x0 // 2, y0 // 2, (x1 + 1) // 2, (y1 + 1) // 2
+            prev = self._levels[n - 1]
+            part = prev.crop((x0 * 2, y0 * 2, min(prev.size[0], x1 * 2), min(prev.size[1], y1 * 2))).reduce(2)
+            self._levels[n].paste(part, (x0, y0))
+
+        for key in list(self._tiles):
+            scale, _, tx, ty = key
+            x0, y0, x1, y1 = self.dirty_rect(box, scale)
+            if tx * VIEW_TILE < x1 and (tx + 1) * VIEW_TILE > x0 and ty * VIEW_TILE < y1 and (ty + 1) * VIEW_TILE > y0:
+                del self._tiles[key]
+
+    @staticmethod
+    def dirty_rect(box, scale):
+        """源图 box 改动后受影响的显示坐标范围 (重采样会波及边缘外一两个像素，略放宽)"""
+        pad = 2 + math.ceil(scale)
+        return (math.floor(box[0] * scale) - pad, math.floor(box[1] * scale) - pad,
+                math.ceil(box[2] * scale) + pad, math.ceil(box[3] * scale) + pad)
+
+    def _level(self, n):
+        """第 n 级 (边长 1/2^n)，按需逐级 reduce(2) 生成"""
+        while len(self._levels) <= n and min(self._levels[-1].size) >= 2:
+            self._levels.append(self._levels[-1].reduce(2))
+        return self._levels[min(n, len(self._levels) - 1)]
+
+    def display_size(self, scale, angle=0):
+        w, h = self._src.size
+        if angle: w, h = rotated_size(w, h, angle)
+        return max(1, int(w * scale)), max(1, int(h * scale))
+
+    def render_rotated(self, scale, angle, rect, method=Image.Resampling.BILINEAR, fill=None):
+        """任意角度：旋转和缩放合成一个仿射变换，从合适的金字塔层一次采样出可见区 (不走瓦片缓存)"""
+        W, H = self._display_size = self.display_size(scale, angle)
+        x0, y0 = max(0, int(rect[0]) - VIEW_MARGIN), max(0, int(rect[1]) - VIEW_MARGIN)
+        x1 = max(x0 + 1, min(W, math.ceil(rect[2]) + VIEW_MARGIN))
+        y1 = max(y0 + 1, min(H, math.ceil(rect[3]) + VIEW_MARGIN))
+
+        level = self._level(int(math.floor(math.log2(1 / scale))) if scale < 1 else 0)
+        sw, sh = self._src.size
+        ow, oh = rotated_size(sw, sh, angle)
+        k = level.size[0] / sw
+        t = math.radians(angle)
+        cs, sn = math.cos(t), math.sin(t)
+        # 输出像素 (u, v) -> 视图坐标 ((u + x0) / scale, ...) -> 绕中心转回 -> 源图坐标 -> 金字塔层坐标
+        X0, Y0 = x0 / scale - ow / 2, y0 / scale - oh / 2
+        data = (k * cs / scale, k * sn / scale, k * (cs * X0 + sn * Y0 + sw / 2),
+                -k * sn / scale, k * cs / scale, k * (-sn * X0 + cs * Y0 + sh / 2))
+        out = level.transform((x1 - x0, y1 - y0), Image.Transform.AFFINE, data, method, fillcolor=fill)
+        return out, (x0, y0)
+
+    def render(self, scale, rect, method=Image.Resampling.BILINEAR):
+        """返回 (视口图, 左上角显示坐标)，覆盖 rect (显示坐标) 外扩 VIEW_MARGIN 后涉及的所有瓦片"""
+        W, H = self._display_size = self.display_size(scale)
+        x0 = max(0, int(rect[0]) - VIEW_MARGIN) // VIEW_TILE
+        y0 = max(0, int(rect[1]) - VIEW_MARGIN) // VIEW_TILE
+        x1 = max(1, min(W, math.ceil(rect[2]) + VIEW_MARGIN))
+        y1 = max(1, min(H, math.ceil(rect[3]) + VIEW_MARGIN))
+        tx1 = max(x0 + 1, math.ceil(x1 / VIEW_TILE))
+        ty1 = max(y0 + 1, math.ceil(y1 / VIEW_TILE))
+
+        ox, oy = x0 * VIEW_TILE, y0 * VIEW_TILE
+        return self.render_box(scale, (ox, oy, min(W, tx1 * VIEW_TILE), min(H, ty1 * VIEW_TILE)), method), (ox, oy)
+
+    def render_box(self, scale, box, method=Image.Resampling.BILINEAR):
+        """由瓦片拼出显示坐标中恰好 box 范围的图 (box 需在图像内)"""
+        W, H = self._display_size = self.display_size(scale)
+        x0, y0, x1, y1 = box
+        out = Image.new(self._src.mode, (x1 - x0, y1 - y0))
+        for ty in range(y0 // VIEW_TILE, math.ceil(y1 / VIEW_TILE)):
+            for tx in range(x0 // VIEW_TILE, math.ceil(x1 / VIEW_TILE)):
+                tile = self._tile(scale, method, tx, ty, W, H)
+                bx, by = tx * VIEW_TILE, ty * VIEW_TILE
+                if bx >= x0 and by >= y0 and bx + tile.size[0] <= x1 and by + tile.size[1] <= y1:
+                    out.paste(tile, (bx - x0, by - y0))
+                else:
+                    out.paste(tile.crop((max(0, x0 - bx), max(0, y0 - by), min(tile.size[0], x1 - bx),
+                                         min(tile.size[1], y1 - by))), (max(0, bx - x0), max(0, by - y0)))
+        return out
+
+    def covers(self, region, rect):
+        """已渲染区域 region 是否覆盖可见范围 rect (均为显示坐标，rect 先裁到图像内)"""
+        W, H = self._display_size
+        x0, y0 = max(0, rect[0]), max(0, rect[1])
+        x1, y1 = min(W, rect[2]), min(H, rect[3])
+        return region[0] <= x0 and region[1] <= y0 and region[2] >= x1 and region[3] >= y1
+
+    def _tile(self, scale, method, tx, ty, W, H):
+        key = (scale, method, tx, ty)
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            return tile
+
+        bx0, by0 = tx * VIEW_TILE, ty * VIEW_TILE
+        bx1, by1 = min(W, bx0 + VIEW_TILE), min(H, by0 + VIEW_TILE)
+        # 选不小于目标尺寸的最小一级，缩小倍数控制在 2 以内
+        n = int(math.floor(math.log2(1 / scale))) if scale < 1 else 0
+        level = self._level(n)
+        rx, ry = level.size[0] / W, level.size[1] / H
+        tile = level.resize((bx1 - bx0, by1 - by0), method, box=(bx0 * rx, by0 * ry, bx1 * rx, by1 * ry))
+
+        self._tiles[key] = tile
+        if len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return tile
+
+
+class PhotoSurface:
+    """画布上的显示层：固定的一个画布图像项 + 按视口尺寸复用的 PhotoImage。
+    尺寸不变时整帧原地 paste；只有脏矩形时把改动块写进暂存 photo，再用 Tk 的 photo copy 拷到目标位置。"""
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.photo = None
+        self.item = None
+        self.pos = None
+        self._scratch = None
+
+    def show(self, img, pos):
+        """整帧显示 img，左上角放在画布坐标 pos"""
+        from PIL import ImageTk
+        if self.photo is None or (self.photo.width(), self.photo.height()) != img.size:
+            self.photo = ImageTk.PhotoImage(img) # 只有视口尺寸变化时才新建
+            if self.item is not None: self.canvas.itemconfigure(self.item, image=self.photo)
+        else:
+            self.photo.paste(img)
+        if self.item is None:
+            self.item = self.canvas.create_image(*pos, anchor=tk.NW, image=self.photo)
+        elif pos != self.pos:
+            self.canvas.coords(self.item, *pos)
+        self.pos = pos
+
+    def update(self, patch, xy):
+        """只把 patch 写到当前 photo 的 xy 处 (photo 内坐标)"""
+        from PIL import ImageTk
+        w, h = patch.size
+        if self._scratch is None or self._scratch.width() < w or self._scratch.height() < h:
+            sw, sh = (self._scratch.width(), self._scratch.height()) if self._scratch else (0, 0)
+            # 暂存 photo 只增不减，按 64 对齐，避免每笔画都新建
+            self._scratch = ImageTk.PhotoImage("RGB", (max(sw, -(-w // 64) * 64), max(sh, -(-h // 64) * 64)))
+        self._scratch.paste(patch) # 从左上角写入 w x h
+        self.photo.tk.call(str(self.photo), "copy", str(self._scratch), "-from", 0, 0, w, h, "-to", *xy)
+
+    def clear(self):
+        if self.item is not None: self.canvas.delete(self.item)
+        self.photo = self.item = self.pos = None
+
+
+class StartupTimer:
+    """启动耗时分解：各阶段相对 STARTUP_T0 的毫秒数"""
+
+    def __init__(self, t0=STARTUP_T0, verbose=False):
+        self.t0 = t0
+        self.verbose = verbose
+        self.marks = []
+        self.done = False
+
+    def mark(self, name):
+        self.marks.append((name, (time.perf_counter() - self.t0) * 1000))
+
+    def finish(self, name):
+        self.mark(name)
+        self.done = True
+        if self.verbose: print(self.report())
+
+    def report(self):
+        parts, last = [], 0.0
+        for name, t in self.marks:
+            parts.append(f"{name} {t:.0f}ms (+{t - last:.0f})")
+            last = t
+        return "启动耗时: " + " | ".join(parts)
+
 
 class ImageEditorApp:
-    def __init__(self, root):
+    def __init__(self, root, startup=None):
         self.root = root
+        self.startup = startup or StartupTimer()
+        self.startup.mark("模块导入")
         self.root.title("琪露诺的完美计概C大作业 - v3.1 (稳健打包版)")
         self.root.geometry("1280x850")
         
@@ -23,16 +2348,28 @@ class ImageEditorApp:
         
         # --- 核心数据 ---
         self.file_path = None
-        self.original_image = None       # 底图
+        self.decode_cache = DecodeCache()  # 同目录浏览的预取 + 已解码缓存
+        self._edit_states = OrderedDict() # 绝对路径 -> 离开该文件时的编辑状态 (最近离开的在后)
+        self._folder = None              # (目录, 目录 mtime_ns, 图片列表)
+        self._browse_step = 1            # 上一次浏览方向，预取优先沿这个方向
+        self.original_image = None       # 底图 (动图为当前预览帧)
         self.drawing_layer = None        # 绘画层
+        self.animation = None            # 多帧图片的 AnimationSource，静态图为 None
+        self.anim_frame = 0              # 当前预览的帧号
         
         # --- 滤镜层 (Overlay) ---
-        self.overlay_image = None        # 当前选中的滤镜图片 (RGBA)
-        self.overlay_pos = [0, 0]        # 滤镜在原图坐标系中的位置 (Center X, Center Y)
+        # 光晕栈 (自下而上)，每层 {'source': 路径或程序化参数, 'image': RGBA, 'pos': 原图坐标中心,
+        # 'opacity': 0-1, 'blend': BLEND_MODES 的键}；移光晕工具操作 active_overlay 指向的那层
+        self.overlays = []
+        self.active_overlay = None
+        self.thumb_cache = None          # 滤镜库磁盘缩略图缓存 (首次打开滤镜库时创建)
         
         # 显示相关
         self.display_image = None
-        self.tk_image = None
+        self.display_scale = 1.0         # display_image 相对原图的缩放 (代理渲染时 < 1)
+        self.display_angle = 0.0         # 视口还要对 display_image 做的拉直角度
+        self.viewport = ViewportRenderer()
+        self._view_region = None         # 当前画布上视口图覆盖的范围 (缩放后图像坐标)
         self.view_scale = 1.0
         self.img_pos_x = 0
         self.img_pos_y = 0
@@ -43,34 +2380,67 @@ class ImageEditorApp:
         self.brush_size = 5
         self.mosaic_strength = 15
         self.processed_mosaic_blocks = set()
+        self._mosaic_last = None         # 马赛克笔迹上一点 (原图坐标)
         
         self.is_drawing = False
         self.last_draw_pos = None
+        self.stroke = StrokeEngine()
+        self._owned_display = None       # 绘画时写时复制出来的显示图
+        self._stroke_exact = False       # 本笔的增量刷新是否与完整渲染逐像素一致
 
         # 参数状态
         self.params = {
             'brightness': 1.0, 'contrast': 1.0, 'saturation': 1.0, 'sharpness': 1.0,
-            'blur': 0, 'rotate': 0, 'flip_h': False, 'flip_v': False
+            'blur': 0, 'rotate': 0, 'flip_h': False, 'flip_v': False, 'angle': 0.0,
+            'crop': None # 原图坐标 (x0, y0, x1, y1)，不裁剪时为 None
         }
 
         # 裁剪状态
         self.crop_start = None
+        self.crop_end = None
         self.crop_rect_id = None
 
-        # 历史记录
-        self.history_stack = []
-        self.history_max_steps = 20
+        # 各导出格式的编码参数 (导出窗口里修改，Ctrl+S 沿用)
+        self.export_options = {fmt: dict(opts) for fmt, (_, opts) in EXPORT_FORMATS.items()}
+
+        # 历史记录 (按内存预算而不是步数限制)
+        self.history = HistoryManager(HISTORY_BUDGET_BYTES)
+
+        # 色彩引擎 (缓存源图统计量) 与分阶段缓存的渲染流水线
+        self.color_engine = ColorEngine()
+        self.histograms = HistogramService() # 直方图面板和智能美化用的代理统计
+        self.profiler = Profiler(trace_path=os.environ.get(PROFILE_TRACE_ENV))
+        self.pipeline = RenderPipeline(self.color_engine, StageCache(), self.profiler)
+        self.show_profile_hud = False
+        self.scheduler = RenderScheduler(self.root, self._on_render_done)
+
+        # 代理预览 (交互时用画布尺寸的缩小副本渲染)
+        self._proxy_cache = {}
+        self._full_render_job = None
+        self._full_render_deferred = False  # 笔画进行中推迟的全分辨率渲染，松手后补上
+        self._loading = None             # 两阶段打开中：{'path', 'preview', 'size', 'queue'}
+        self.layer_version = 0           # 绘画层每次改动 +1，用于让缓存失效
+
+        # 资源目录在窗口显示后才确定 (见 _deferred_startup)
+        self.resource_dir = None
 
-        # --- [关键修改] 智能路径获取与容错 ---
-        self.resource_dir = self._determine_resource_path()
-            
-        self._ensure_halo_assets() # 自动生成演示用的光晕素材
         self._setup_layout()
         self._bind_events()
         self._bind_shortcuts()
+        self.startup.mark("界面构建")
+
+        # 窗口先出来：after_idle 排在布局/映射之后，再 after(0) 让出一轮事件让窗口绘制完
+        self.root.after_idle(lambda: self.root.after(0, self._deferred_startup))
+
+    def _deferred_startup(self):
+        """窗口显示之后再做的启动工作：资源目录、默认图 (光晕改为程序化生成，不再写素材文件)"""
+        self.startup.mark("窗口显示")
+        # --- [关键修改] 智能路径获取与容错 ---
+        self.resource_dir = self._determine_resource_path()
 
         # 加载默认图
-        self._load_default_image()
+        if not self._load_default_image():
+            self.startup.finish("无默认图")
 
     def _determine_resource_path(self):
         """决定资源文件的存放路径，优先本地，失败则转临时目录"""
@@ -89,11 +2459,9 @@ class ImageEditorApp:
         try:
             # 如果不存在，尝试创建（这步会触发 PermissionError 如果无权限）
             os.makedirs(local_resource, exist_ok=True)
-            # 尝试写入一个测试文件来确认权限
-            test_file = os.path.join(local_resource, ".permission_test")
-            with open(test_file, 'w') as f:
-                f.write("test")
-            os.remove(test_file)
+            # 用 os.access 判断权限，不再每次启动写删测试文件
+            if not os.access(local_resource, os.W_OK):
+                raise PermissionError(local_resource)
             
             # 如果成功，就用这个路径
             return local_resource
@@ -107,44 +2475,6 @@ class ImageEditorApp:
             except:
                 return None # 彻底无法写入
 
-    def _ensure_halo_assets(self):
-        """生成演示用的光晕素材"""
-        if not self.resource_dir:
-            print("警告：无可用资源目录，滤镜库将为空。")
-            return
-
-        # 使用计算好的安全路径
-        halo_dir = os.path.join(self.resource_dir, "filter", "halo")
-        
-        try:
-            os.makedirs(halo_dir, exist_ok=True)
-                
-            configs = [
-                ("halo1.png", "#ffeb3b", 200),
-                ("halo2.png", "#ff9800", 250),
-                ("halo3.png", "#00d2d3", 180),
-            ]
-            
-            for name, color, size in configs:
-                path = os.path.join(halo_dir, name)
-                if not os.path.exists(path):
-                    img = Image.new("RGBA", (size, size), (0,0,0,0))
-                    draw = ImageDraw.Draw(img)
-                    c = size // 2
-                    try:
-                        rgb = self.root.winfo_rgb(color) 
-                        r, g, b = rgb[0]//256, rgb[1]//256, rgb[2]//256
-                    except:
-                        r, g, b = 255, 255, 255 
-
-                    for i in range(c, 0, -2):
-                        alpha = int((1 - i/c) * 100)
-                        draw.ellipse((c-i, c-i, c+i, c+i), fill=(r, g, b, alpha))
-                    draw.ellipse((c-10, c-10, c+10, c+10), fill=(255, 255, 255, 200))
-                    img.save(path)
-        except Exception as e:
-            print(f"资源生成失败: {e}")
-
     def _setup_layout(self):
         self.top_bar = tk.Frame(self.root, bg=self.colors["tool_bg"], height=40)
         self.top_bar.pack(side=tk.TOP, fill=tk.X)
@@ -161,8 +2491,9 @@ class ImageEditorApp:
         self.workspace = tk.Frame(self.root, bg=self.colors["bg"])
         self.workspace.pack(fill=tk.BOTH, expand=True)
 
-        self.canvas = tk.Canvas(self.workspace, bg="#282828", highlightthickness=0)
+        self.canvas = tk.Canvas(self.workspace, bg=CANVAS_BG, highlightthickness=0)
         self.canvas.pack(fill=tk.BOTH, expand=True, padx=2, pady=2)
+        self.surface = PhotoSurface(self.canvas)
         
         self.info_label = tk.Label(self.canvas, text="Ready", bg=self.colors["panel"], fg=self.colors["text"], font=("Consolas", 9))
         self.info_label.place(relx=0.01, rely=0.99, anchor=tk.SW)
@@ -174,18 +2505,41 @@ class ImageEditorApp:
     def _build_top_bar(self):
         self._create_top_btn("📂 打开", self.open_image)
         self._create_top_btn("💾 保存", self.save_image)
+        self._create_top_btn("📤 导出", self.open_export_window)
         self._create_top_btn("📦 批量", self.open_batch_processor_window)
+        self._create_top_btn("◀", lambda: self.show_adjacent(-1))
+        self._create_top_btn("▶", lambda: self.show_adjacent(1))
         
         tk.Label(self.top_bar, text="|", bg=self.colors["tool_bg"], fg="#666").pack(side=tk.LEFT, padx=5)
         self._create_top_btn("✨ 滤镜库", self.open_filter_library, bg="#e17055") # 新增滤镜库按钮
         tk.Label(self.top_bar, text="|", bg=self.colors["tool_bg"], fg="#666").pack(side=tk.LEFT, padx=5)
         self._create_top_btn("↩ 撤销", self.undo)
+        self._create_top_btn("↪ 重做", self.redo)
 
         # 动态属性栏
         self.prop_frame = tk.Frame(self.top_bar, bg=self.colors["tool_bg"])
         self.prop_frame.pack(side=tk.LEFT, padx=20)
         self.prop_label = tk.Label(self.prop_frame, text="", bg=self.colors["tool_bg"], fg="#aaa")
-        self.prop_label.pack()
+        self.prop_label.pack(side=tk.LEFT)
+        # 移光晕工具下才显示：切换当前层、混合模式、不透明度、(程序化光晕) 颜色
+        self.overlay_props = tk.Frame(self.prop_frame, bg=self.colors["tool_bg"])
+        tk.Button(self.overlay_props, text="⇄ 切换", command=self.cycle_overlay,
+                  bg=self.colors["btn_active"], fg=self.colors["text"], relief=tk.FLAT).pack(side=tk.LEFT, padx=4)
+        self.overlay_blend_var = tk.StringVar(value=BLEND_MODES["normal"])
+        blend_menu = tk.OptionMenu(self.overlay_props, self.overlay_blend_var, *BLEND_MODES.values(),
+                                   command=lambda label: self.set_overlay_props(
+                                       blend={v: k for k, v in BLEND_MODES.items()}[label]))
+        blend_menu.config(bg=self.colors["btn_active"], fg=self.colors["text"], relief=tk.FLAT, highlightthickness=0)
+        blend_menu.pack(side=tk.LEFT, padx=4)
+        tk.Label(self.overlay_props, text="不透明度", bg=self.colors["tool_bg"], fg="#aaa").pack(side=tk.LEFT)
+        self.overlay_opacity = tk.Scale(self.overlay_props, from_=0, to=100, orient=tk.HORIZONTAL, length=90,
+                                        bg=self.colors["tool_bg"], fg="#ddd", highlightthickness=0, showvalue=0,
+                                        troughcolor="#555",
+                                        command=lambda v: self.set_overlay_props(opacity=float(v) / 100))
+        self.overlay_opacity.bind("<ButtonPress-1>", self.save_history_snapshot)
+        self.overlay_opacity.pack(side=tk.LEFT, padx=4)
+        self.overlay_color_btn = tk.Button(self.overlay_props, text="🎨 光晕颜色", command=self.pick_overlay_color,
+                                           bg=self.colors["btn_active"], fg=self.colors["text"], relief=tk.FLAT)
 
     def _create_top_btn(self, text, cmd, bg=None):
         tk.Button(self.top_bar, text=text, command=cmd, 
@@ -213,6 +2567,23 @@ class ImageEditorApp:
         self._update_tool_visuals()
 
     def _build_right_panel(self):
+        self.sliders = {}
+        self._create_panel_header("直方图")
+        self.hist_canvas = tk.Canvas(self.right_panel, height=HIST_PANEL_HEIGHT, bg=self.colors["bg"], highlightthickness=0)
+        self.hist_canvas.pack(fill=tk.X, padx=10)
+        # 三条折线常驻，刷新时只改坐标
+        self.hist_lines = [self.hist_canvas.create_line(0, 0, 0, 0, fill=c) for c in ("#ff6b6b", "#51cf66", "#4dabf7")]
+        self._hist_drawn = None
+        # 动图才显示：拖动切换预览帧
+        self.anim_bar = tk.Frame(self.right_panel, bg=self.colors["panel"])
+        tk.Label(self.anim_bar, text="帧", bg=self.colors["panel"], fg="#ddd", width=8, anchor="w").pack(side=tk.LEFT)
+        self.anim_label = tk.Label(self.anim_bar, text="", bg=self.colors["panel"], fg="#aaa", width=12, anchor="e")
+        self.anim_label.pack(side=tk.RIGHT)
+        self.anim_scale = tk.Scale(self.anim_bar, from_=0, to=0, orient=tk.HORIZONTAL,
+                                   bg=self.colors["panel"], fg="#ddd", highlightthickness=0, showvalue=0, troughcolor="#555",
+                                   command=lambda v: self.show_frame(int(float(v))))
+        self.anim_scale.pack(side=tk.LEFT, fill=tk.X, expand=True)
+
         self._create_panel_header("几何变换")
         f_rot = tk.Frame(self.right_panel, bg=self.colors["panel"])
         f_rot.pack(fill=tk.X, padx=10)
@@ -222,9 +2593,10 @@ class ImageEditorApp:
         f_flip.pack(fill=tk.X, padx=10, pady=5)
         tk.Button(f_flip, text="水平翻转", bg=self.colors["btn_active"], fg="white", relief=tk.FLAT, command=lambda: self.flip_image('h')).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=1)
         tk.Button(f_flip, text="垂直翻转", bg=self.colors["btn_active"], fg="white", relief=tk.FLAT, command=lambda: self.flip_image('v')).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=1)
+        self._create_slider("Straighten", "angle", -45, 45, 0.5)
+        tk.Button(self.right_panel, text="取消裁剪", bg=self.colors["btn_active"], fg="white", relief=tk.FLAT, command=self.clear_crop).pack(fill=tk.X, padx=10, pady=(5, 0))
 
         self._create_panel_header("色彩调整")
-        self.sliders = {}
         for k in ["brightness", "contrast", "saturation"]:
             self._create_slider(k.capitalize(), k, 0.0, 2.0)
         
@@ -247,13 +2619,13 @@ class ImageEditorApp:
                     command=lambda v: self.on_param_change(key, v))
         s.set(self.params[key])
         s.pack(side=tk.LEFT, fill=tk.X, expand=True)
-        s.bind("<ButtonRelease-1>", self.save_history_snapshot)
+        s.bind("<ButtonPress-1>", self.save_history_snapshot) # 拖动前记录，撤销回到拖动前
         self.sliders[key] = s
 
     # --- 滤镜库功能 ---
 
     def open_filter_library(self):
-        """打开滤镜选择窗口"""
+        """打开滤镜选择窗口：内置程序化光晕 + 资源目录中的 PNG 素材"""
         if not self.original_image:
             messagebox.showwarning("提示", "请先打开一张图片")
             return
@@ -263,75 +2635,44 @@ class ImageEditorApp:
         win.geometry("600x400")
         win.configure(bg=self.colors["bg"])
         
-        tk.Label(win, text="选择光晕样式 (可拖动调整位置)", font=("Arial", 12), bg=self.colors["bg"], fg="white").pack(pady=10)
-        
-        scroll_frame = tk.Frame(win, bg=self.colors["bg"])
-        scroll_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
-        
-        # 扫描资源文件夹 (使用资源目录)
-        if not self.resource_dir:
-             tk.Label(scroll_frame, text="资源目录不可用，无法加载滤镜", bg=self.colors["bg"], fg="white").pack()
-             return
-
-        halo_dir = os.path.join(self.resource_dir, "filter", "halo")
-        
-        # 确保目录存在 (再次检查)
-        if not os.path.exists(halo_dir):
-            try:
-                os.makedirs(halo_dir, exist_ok=True)
-                self._ensure_halo_assets()
-            except: pass
-
-        if os.path.exists(halo_dir):
-            files = [f for f in os.listdir(halo_dir) if f.endswith(".png")]
-        else:
-            files = []
-        
-        # 网格布局显示缩略图
-        col = 0
-        row = 0
+        tk.Label(win, text="选择光晕样式 (可拖动调整位置，滚轮调整大小)", font=("Arial", 12), bg=self.colors["bg"], fg="white").pack(pady=10)
         
-        if not files:
-            tk.Label(scroll_frame, text="暂无滤镜，请检查资源文件夹", bg=self.colors["bg"], fg="white").pack()
-            
-        for f in files:
-            path = os.path.join(halo_dir, f)
-            try:
-                # 制作缩略图
-                thumb_img = Image.open(path)
-                thumb_img.thumbnail((100, 100))
-                tk_thumb = ImageTk.PhotoImage(thumb_img)
-                
-                btn_frame = tk.Frame(scroll_frame, bg=self.colors["panel"], padx=5, pady=5)
-                btn_frame.grid(row=row, column=col, padx=10, pady=10)
-                
-                lbl = tk.Label(btn_frame, image=tk_thumb, bg=self.colors["panel"])
-                lbl.image = tk_thumb # keep reference
-                lbl.pack()
-                
-                tk.Button(btn_frame, text=f"应用 {f}", bg=self.colors["accent"], fg="white",
-                         command=lambda p=path: self.apply_overlay(p, win)).pack(fill=tk.X, marginTop=5)
-                
-                col += 1
-                if col > 3:
-                    col = 0
-                    row += 1
-            except Exception as e:
-                print(e)
-                
-        # 清除按钮
+        # 清除按钮 (先 pack 到底部，网格占据剩余空间)
         tk.Button(win, text="清除当前滤镜", bg="#d63031", fg="white", 
                  command=lambda: self.clear_overlay(win)).pack(side=tk.BOTTOM, pady=20)
 
-    def apply_overlay(self, path, win):
-        """应用选中的滤镜"""
+        grid_frame = tk.Frame(win, bg=self.colors["bg"])
+        grid_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
+
+        # 内置光晕直接由参数生成，无需资源目录
+        items = [(name, spec) for name, spec in OVERLAY_PRESETS]
+
+        # 资源文件夹中用户自己放入的素材：这里只列文件名，缩略图由网格按需在后台生成
+        if self.resource_dir:
+            halo_dir = os.path.join(self.resource_dir, "filter", "halo")
+            if os.path.isdir(halo_dir):
+                names = sorted(e.name for e in os.scandir(halo_dir) if e.name.endswith(".png"))
+                items += [(f, os.path.join(halo_dir, f)) for f in names]
+
+        VirtualThumbGrid(grid_frame, items, self._thumb_cache(),
+                         lambda src: self.apply_overlay(src, win), self.colors)
+
+    def _thumb_cache(self):
+        if not self.thumb_cache:
+            base = self.resource_dir or os.path.join(tempfile.gettempdir(), "LitePixel_Resources")
+            self.thumb_cache = ThumbnailCache(os.path.join(base, "cache", "thumbs"))
+        return self.thumb_cache
+
+    def apply_overlay(self, source, win):
+        """把选中的滤镜作为新的一层压到光晕栈顶；source 为素材路径或程序化光晕参数"""
         try:
             self.save_history_snapshot()
-            self.overlay_image = Image.open(path).convert("RGBA")
-            
+            source = dict(source) if isinstance(source, dict) else source
             # 默认放置在图片中心
             w, h = self.original_image.size
-            self.overlay_pos = [w//2, h//2]
+            self.overlays.append({'source': source, 'image': load_overlay(source), 'pos': [w//2, h//2],
+                                  'opacity': 1.0, 'blend': "normal"})
+            self.active_overlay = len(self.overlays) - 1
             
             self.set_tool("move_overlay") # 自动切换到移动滤镜工具
             self.update_preview()
@@ -340,10 +2681,67 @@ class ImageEditorApp:
         except Exception as e:
             messagebox.showerror("错误", str(e))
 
+    def _current_overlay(self):
+        if self.active_overlay is None or self.active_overlay >= len(self.overlays): return None
+        return self.overlays[self.active_overlay]
+
+    def _overlay_layers(self):
+        """光晕栈快照，交给渲染流水线"""
+        return [OverlayLayer(o['image'], tuple(o['pos']), o['opacity'], o['blend']) for o in self.overlays]
+
+    def adjust_overlay(self, **changes):
+        """修改当前程序化光晕的参数 (大小、颜色等)，从内存缓存取图，不落盘"""
+        overlay = self._current_overlay()
+        if not overlay or not isinstance(overlay['source'], dict): return
+        overlay['source'] = dict(overlay['source'], **changes)
+        overlay['image'] = generate_overlay(**overlay['source'])
+        self.update_preview(proxy=True)
+
+    def set_overlay_props(self, **changes):
+        """修改当前层的不透明度 / 混合模式"""
+        overlay = self._current_overlay()
+        if not overlay or all(overlay[k] == v for k, v in changes.items()): return
+        if 'blend' in changes: self.save_history_snapshot() # 不透明度滑块按下时已记录
+        overlay.update(changes)
+        self.update_preview(proxy='opacity' in changes)
+
+    def cycle_overlay(self):
+        if not self.overlays: return
+        self.active_overlay = ((self.active_overlay or 0) + 1) % len(self.overlays)
+        self._sync_overlay_props()
+
+    def _sync_overlay_props(self):
+        """属性栏显示当前层的设置"""
+        overlay = self._current_overlay()
+        if self.current_tool != "move_overlay" or not overlay:
+            self.overlay_props.pack_forget()
+            return
+        self.overlay_props.pack(side=tk.LEFT, padx=8)
+        self.overlay_blend_var.set(BLEND_MODES[overlay['blend']])
+        self.overlay_opacity.set(round(overlay['opacity'] * 100))
+        if isinstance(overlay['source'], dict):
+            self.overlay_color_btn.pack(side=tk.LEFT, padx=4)
+        else:
+            self.overlay_color_btn.pack_forget()
+        self.prop_label.config(text=f"拖动调整光晕位置，滚轮调整大小 (第 {self.active_overlay + 1}/{len(self.overlays)} 层)")
+
+    def pick_overlay_color(self):
+        overlay = self._current_overlay()
+        if not overlay or not isinstance(overlay['source'], dict): return
+        from tkinter import colorchooser
+        color = colorchooser.askcolor(overlay['source'].get("color", "#ffffff"), title="光晕颜色")[1]
+        if color:
+            self.save_history_snapshot()
+            self.adjust_overlay(color=color)
+
     def clear_overlay(self, win):
-        self.save_history_snapshot()
-        self.overlay_image = None
-        self.update_preview()
+        """移除当前层"""
+        if self._current_overlay():
+            self.save_history_snapshot()
+            del self.overlays[self.active_overlay]
+            self.active_overlay = len(self.overlays) - 1 if self.overlays else None
+            self._sync_overlay_props()
+            self.update_preview()
         win.destroy()
 
     # --- 核心逻辑 ---
@@ -353,129 +2751,416 @@ class ImageEditorApp:
             default_path = os.path.join(self.resource_dir, "pic", "simple.png")
             if os.path.exists(default_path):
                 self.load_image_from_path(default_path)
+                return True
+        return False
+
+    def load_image_from_path(self, path, report_errors=True):
+        """两阶段打开：先同步解码一张画布大小的预览立即显示，全分辨率在后台线程解码，
+        完成后替换预览；期间调整的参数保存在 self.params 里，直接作用于全分辨率图。
+        已预取解码好的文件直接换上；之前编辑过的文件恢复离开时的参数、光晕和绘画层。
+        返回是否成功打开"""
+        cached = self.decode_cache.get(path)
+        if cached is None:
+            try:
+                if self.decode_cache.pending(path) is not None:
+                    # 预取已经在解码这张图：只读文件头取尺寸，不在主线程再解一遍预览
+                    with Image.open(path) as im: preview, full_size = None, im.size
+                else:
+                    target = (max(1, self.canvas.winfo_width()), max(1, self.canvas.winfo_height()))
+                    preview, full_size = decode_preview(path, target)
+            except Exception as e:
+                if report_errors: messagebox.showerror("Error", str(e))
+                return False
+
+        self._stash_edit_state()
+        self.scheduler.cancel() # 上一张图还没渲染完的结果不要了
+        self._loading = None
+        self.file_path = path
+        self.original_image = None
+        self.drawing_layer = None
+        self.overlays = [] # 重置滤镜
+        self.active_overlay = None
+        self.reset_params(skip_render=True)
+        self.history.clear()
+        self.view_scale = 1.0
+        self._restore_edit_state()
+        if self.animation: self.animation.close()
+        self.animation, self.anim_frame = open_animation(path), 0
+        self._sync_animation_bar()
 
-    def load_image_from_path(self, path):
-        try:
-            self.file_path = path
-            img = Image.open(path).convert("RGB")
-            self.original_image = img
-            self.drawing_layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
-            self.overlay_image = None # 重置滤镜
-            
-            self.reset_params(skip_render=True)
-            self.history_stack = []
-            self.save_history_snapshot()
-            
-            self.view_scale = 1.0
-            self.update_preview()
+        self.display_image = None
+        self.canvas.delete("all")
+        self.surface.clear()
+        if cached is not None:
+            self._set_full_image(cached)
             self.info_label.config(text=f"Loaded: {os.path.basename(path)}")
+        else:
+            # 相邻文件可能正在预取，直接等同一个解码任务
+            self._loading = {'path': path, 'preview': preview, 'size': full_size, 'future': self.decode_cache.request(path)}
+            if preview: self.update_preview()
+            self.info_label.config(text=f"Loading: {os.path.basename(path)} ({full_size[0]}x{full_size[1]})")
+            self.root.after(30, self._poll_full_decode, self._loading)
+        self._prefetch_neighbors()
+        return True
+
+    def _poll_full_decode(self, loading):
+        if loading is not self._loading: return # 期间又打开了别的图
+        if not loading['future'].done():
+            self.root.after(30, self._poll_full_decode, loading)
+            return
+        self._loading = None
+        try:
+            result = loading['future'].result()
         except Exception as e:
             messagebox.showerror("Error", str(e))
+            return
+        self._set_full_image(result)
+        self.info_label.config(text=f"Loaded: {os.path.basename(loading['path'])}")
+
+    def _set_full_image(self, img):
+        """换上全分辨率原图 (解码缓存里的图是共享的，不得原地修改)，并恢复该文件之前画过的内容"""
+        self.original_image = img
+        if self.animation: self.animation.put(0, img) # 第 0 帧就是这张图，拖回来时复用同一对象
+        state = self._edit_states.get(os.path.abspath(self.file_path))
+        if state and state['layer'] and state['size'] == img.size:
+            self.drawing_layer = state['layer']
+        else:
+            self.drawing_layer = TiledLayer(img.size) # 没画过时不占像素内存
+        self.layer_version += 1
+        self.update_preview()
+
+    # --- 目录浏览 ---
+
+    def _stash_edit_state(self):
+        """离开当前文件前记下编辑状态；绘画层对象直接保留 (只占已分配的瓦片)。
+        全分辨率还在解码时 (预览阶段) 也记下参数、裁剪和光晕，绘画层沿用上次离开时的"""
+        if not self.file_path: return
+        key = os.path.abspath(self.file_path)
+        previous = self._edit_states.pop(key, None)
+        if self.original_image:
+            size, layer = self.original_image.size, self.drawing_layer if self.drawing_layer.getbbox() else None
+        elif self._loading:
+            size, layer = self._loading['size'], previous and previous['layer']
+        else:
+            return
+        self._edit_states[key] = {
+            'params': self.params.copy(),
+            'overlays': [dict(o) for o in self.overlays],
+            'active_overlay': self.active_overlay,
+            'size': size,
+            'layer': layer,
+        }
+        # 绘画层按字节预算保留，超出时丢弃最早离开的文件的编辑状态
+        held = [(k, st['layer'].nbytes) for k, st in self._edit_states.items() if st['layer'] is not None]
+        total = sum(n for _, n in held)
+        for k, n in held[:-1]:
+            if total <= EDIT_STATE_BUDGET_BYTES: break
+            del self._edit_states[k]
+            total -= n
+
+    def _restore_edit_state(self):
+        state = self._edit_states.get(os.path.abspath(self.file_path))
+        if not state: return
+        self.params.update(state['params'])
+        self.overlays = [dict(o) for o in state['overlays']]
+        self.active_overlay = state['active_overlay']
+        for k, v in self.params.items():
+            if k in self.sliders: self.sliders[k].set(v)
+        self._sync_overlay_props()
+
+    def _folder_files(self):
+        """当前文件所在目录的图片列表，目录未变化时复用"""
+        folder = os.path.dirname(os.path.abspath(self.file_path))
+        try: mtime = os.stat(folder).st_mtime_ns
+        except OSError: return []
+        if not self._folder or self._folder[:2] != (folder, mtime):
+            self._folder = (folder, mtime, folder_images(folder))
+        return self._folder[2]
+
+    def show_adjacent(self, step):
+        """同目录的上一张 (-1) / 下一张 (+1)"""
+        if not self.file_path: return
+        files = self._folder_files()
+        here = os.path.abspath(self.file_path)
+        if here in files:
+            i = files.index(here) + step
+        else: # 当前文件已被删除或改名：从排序位置继续
+            i = sum(1 for f in files if f.lower() < here.lower()) + (0 if step > 0 else -1)
+        self._browse_step = 1 if step > 0 else -1
+        skipped = 0
+        while 0 <= i < len(files): # 打不开的文件跳过
+            if self.load_image_from_path(files[i], report_errors=False):
+                if skipped: self.info_label.config(text=f"已跳过 {skipped} 个无法打开的文件")
+                return
+            skipped += 1
+            i += self._browse_step
+        self.info_label.config(text="已是最后一张" if step > 0 else "已是第一张")
+
+    def _prefetch_neighbors(self):
+        """当前文件优先，然后沿浏览方向 PREFETCH_AHEAD 张、反方向 PREFETCH_BEHIND 张"""
+        files = self._folder_files()
+        here = os.path.abspath(self.file_path)
+        if here not in files: return
+        i, d = files.index(here), self._browse_step
+        order = [here]
+        for k in range(1, max(PREFETCH_AHEAD, PREFETCH_BEHIND) + 1):
+            if k <= PREFETCH_AHEAD and 0 <= i + k * d < len(files): order.append(files[i + k * d])
+            if k <= PREFETCH_BEHIND and 0 <= i - k * d < len(files): order.append(files[i - k * d])
+        self.decode_cache.prefetch(order)
 
     def open_image(self):
         path = filedialog.askopenfilename()
         if path: self.load_image_from_path(path)
 
-    # --- 渲染流水线 (Updated for Overlay) ---
+    # --- 动画 ---
 
-    def update_preview(self, *args):
-        if not self.original_image: return
+    def _sync_animation_bar(self):
+        """动图显示帧滑块，静态图隐藏"""
+        if self.animation:
+            self.anim_scale.config(to=self.animation.n_frames - 1)
+            self.anim_scale.set(0)
+            self.anim_bar.pack(fill=tk.X, padx=10, pady=(5, 0), after=self.hist_canvas)
+            self._update_frame_label()
+        else:
+            self.anim_bar.pack_forget()
 
-        # 1. 基础处理
-        img = self.original_image.copy()
-        
-        # 几何变换 (Rotate/Flip)
-        # 注意：为了让滤镜跟随图片旋转，我们先叠加滤镜，再旋转？
-        # 需求是：滤镜位置可拖动。通常滤镜(如光晕)是相对于画面的。
-        # 如果先旋转再叠加，坐标系会很乱。
-        # 最佳实践：所有图层在"世界坐标系"（未旋转）对齐，最后一起旋转。
-        
-        # 色彩
-        if self.params['brightness'] != 1.0: img = ImageEnhance.Brightness(img).enhance(self.params['brightness'])
-        if self.params['contrast'] != 1.0: img = ImageEnhance.Contrast(img).enhance(self.params['contrast'])
-        if self.params['saturation'] != 1.0: img = ImageEnhance.Color(img).enhance(self.params['saturation'])
-        if self.params['sharpness'] != 1.0: img = ImageEnhance.Sharpness(img).enhance(self.params['sharpness'])
-        if self.params['blur'] > 0: img = img.filter(ImageFilter.GaussianBlur(self.params['blur']))
+    def _update_frame_label(self):
+        anim, i = self.animation, self.anim_frame
+        duration = anim.durations[i]
+        self.anim_label.config(text=f"{i + 1}/{anim.n_frames}" + (f"  {duration}ms" if duration else ""))
 
-        # 2. 叠加绘画层
-        if self.drawing_layer:
-            img.paste(self.drawing_layer, (0, 0), self.drawing_layer)
-
-        # 3. 叠加光晕滤镜 (Overlay)
-        if self.overlay_image:
-            # 计算粘贴位置 (中心点对齐)
-            ow, oh = self.overlay_image.size
-            cx, cy = self.overlay_pos
-            paste_x = int(cx - ow//2)
-            paste_y = int(cy - oh//2)
-            
-            # 创建临时层以处理透明度混合
-            temp_overlay_layer = Image.new("RGBA", img.size, (0,0,0,0))
-            try:
-                temp_overlay_layer.paste(self.overlay_image, (paste_x, paste_y), self.overlay_image)
-                img.paste(temp_overlay_layer, (0,0), temp_overlay_layer)
-            except: pass # 防止坐标越界报错
+    def show_frame(self, i):
+        """预览切到第 i 帧；最近的帧、它们的代理和各阶段渲染结果都有缓存，来回拖动不重复计算"""
+        if not (self.animation and self.original_image) or i == self.anim_frame: return
+        try:
+            img = self.animation.frame(i)
+        except Exception as e:
+            self.info_label.config(text=f"第 {i + 1} 帧解码失败: {e}")
+            return
+        self.anim_frame = i
+        self.original_image = img
+        self._update_frame_label()
+        self.update_preview(proxy=True)
 
-        # 4. 全局几何变换 (最后执行，保证所有元素一起转)
-        if self.params['rotate'] != 0:
-            img = img.rotate(-self.params['rotate'], expand=True)
-        if self.params['flip_h']: img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        if self.params['flip_v']: img = img.transpose(Image.FLIP_TOP_BOTTOM)
+    # --- 渲染流水线 (Updated for Overlay) ---
+
+    def update_preview(self, *args, proxy=False):
+        """提交一次渲染到后台线程；proxy=True 时在画布尺寸的缩小副本上渲染 (交互中)，空闲后再补全分辨率"""
+        if not self.original_image and not (self._loading and self._loading['preview']): return
 
-        self.display_image = img
+        if proxy:
+            self._schedule_full_render()
+        else:
+            self._cancel_full_render()
+
+        # 在主线程拍下当前状态，后台线程只读这些快照
+        image, layer, layer_version = self.original_image, self.drawing_layer, self.layer_version
+        params, overlays = self.params.copy(), self._overlay_layers()
+        canvas_size = (self.canvas.winfo_width(), self.canvas.winfo_height()) if proxy else None
+        preview = self._loading['preview'] if image is None else None
+        if preview: preview_scale = preview.size[0] / self._loading['size'][0]
+
+        def job(cancelled):
+            job_params, job_overlays = params, overlays
+            if preview:
+                # 全分辨率还在解码：预览图本身就是画布大小的代理
+                base, base_layer, scale = preview, None, preview_scale
+            elif canvas_size:
+                # 代理只取裁剪区域：裁得越紧代理越清晰、渲染越快
+                roi = crop_box(params, image.size)
+                base, base_layer, scale = self._get_proxy(image, layer, layer_version, canvas_size, roi)
+                if roi: job_params, job_overlays = dict(params, crop=None), shift_overlays(overlays, *roi[:2])
+            else:
+                base, base_layer, scale = image, layer, 1.0
+            img = self.pipeline.render(base, job_params, base_layer, job_overlays, scale=scale,
+                                       layer_version=layer_version, cancelled=cancelled, free_angle=False) # 拉直由视口完成
+            return img, scale, Geometry.from_params(params).angle
+
+        self.scheduler.submit(job)
+
+    def _on_render_done(self, result):
+        if self.is_drawing:
+            # 这张图在最近的增量刷新之前就开始渲染了，换上去笔迹会闪掉；丢弃，松手后补一次完整渲染
+            self._stroke_exact = False
+            return
+        self.display_image, self.display_scale, self.display_angle = result
         self.render_canvas()
+        if not self.startup.done:
+            self.startup.finish("首帧")
+
+    def _get_proxy(self, image, layer, layer_version, canvas_size, roi=None):
+        """返回 (代理底图, 代理绘画层, 缩放比)，只覆盖 roi (原图坐标，None 为整图)，
+        按画布尺寸和 roi 缓存 (在渲染线程中调用)"""
+        roi = roi or (0, 0) + image.size
+        w, h = roi[2] - roi[0], roi[3] - roi[1]
+        c_w, c_h = max(1, canvas_size[0]), max(1, canvas_size[1])
+        scale = min(1.0, max(c_w / w, c_h / h))
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+
+        cache = self._proxy_cache
+        if cache.get('size') != size or cache.get('roi') != roi:
+            cache.clear()
+            cache.update(size=size, roi=roi, images=OrderedDict())
+        # 每个源图 (动图的每一帧) 各一张代理，同一帧始终得到同一个代理对象，后续阶段缓存才能命中
+        images = cache['images']
+        entry = images.get(id(image))
+        if entry is None or entry[0]() is not image:
+            for key in [k for k, (ref, _) in images.items() if ref() is None]: del images[key]
+            entry = images[id(image)] = (weakref.ref(image),
+                                         image.resize(size, Image.Resampling.BILINEAR, box=roi, reducing_gap=2.0))
+            while len(images) > ANIMATION_FRAME_CACHE: images.popitem(last=False)
+        images.move_to_end(id(image))
+        if cache.get('layer_src') is not layer or cache.get('layer_version') != layer_version:
+            cache['layer_src'] = layer
+            cache['layer_version'] = layer_version
+            cache['layer'] = layer.resize(size, Image.Resampling.BILINEAR, box=roi) if layer is not None else None
+        return entry[1], cache['layer'], size[0] / w
+
+    def _schedule_full_render(self):
+        self._cancel_full_render()
+        if self.is_drawing: # 笔画进行中不整图替换显示图，否则还没合进去的笔迹会闪掉
+            self._full_render_deferred = True
+            return
+        self._full_render_job = self.root.after(PROXY_IDLE_MS, self.update_preview)
 
-    def render_canvas(self):
+    def _cancel_full_render(self):
+        if self._full_render_job:
+            self.root.after_cancel(self._full_render_job)
+            self._full_render_job = None
+
+    def render_canvas(self, dirty=None):
+        """只渲染可见区域 (+边距)：从金字塔取瓦片拼成视口图放到画布对应位置；
+        有拉直角度时旋转和缩放合成一次仿射采样。
+        dirty 为 display_image 坐标中改动的矩形：视口没动时只把这一块推给显示层"""
         if not self.display_image: return
-        w, h = self.display_image.size
-        new_w = int(w * self.view_scale)
-        new_h = int(h * self.view_scale)
-        
-        method = Image.Resampling.NEAREST if self.view_scale > 3 else Image.Resampling.BILINEAR
-        pil_img = self.display_image.resize((new_w, new_h), method)
-        self.tk_image = ImageTk.PhotoImage(pil_img)
-        
-        self.canvas.delete("all")
+        # display_image 可能是代理分辨率，先换算回原图尺寸再乘缩放
+        scale = self.view_scale / self.display_scale
+        angle = self.display_angle
+        self.viewport.set_image(self.display_image)
+        new_w, new_h = self.viewport.display_size(scale, angle)
+
         c_w = self.canvas.winfo_width()
         c_h = self.canvas.winfo_height()
         self.img_pos_x = max(0, (c_w - new_w) // 2)
         self.img_pos_y = max(0, (c_h - new_h) // 2)
-        
-        self.canvas.create_image(self.img_pos_x, self.img_pos_y, anchor=tk.NW, image=self.tk_image, tags="img")
+
+        method = Image.Resampling.NEAREST if self.view_scale > 3 else Image.Resampling.BILINEAR
+        if (dirty and not angle and self._view_region and self.surface.photo is not None and
+                self.surface.pos == (self.img_pos_x + self._view_region[0], self.img_pos_y + self._view_region[1]) and
+                self.viewport.covers(self._view_region, self._visible_rect())):
+            self._push_dirty(scale, dirty, method)
+            return
+
+        with self.profiler.stage("viewport"):
+            if angle:
+                fill = tuple(c // 257 for c in self.canvas.winfo_rgb(CANVAS_BG))
+                region, (ox, oy) = self.viewport.render_rotated(scale, angle, self._visible_rect(), method, fill)
+            else:
+                region, (ox, oy) = self.viewport.render(scale, self._visible_rect(), method)
+        self._view_region = (ox, oy, ox + region.size[0], oy + region.size[1])
+        with self.profiler.stage("photo"):
+            self.surface.show(region, (self.img_pos_x + ox, self.img_pos_y + oy))
         self.canvas.config(scrollregion=(0, 0, new_w, new_h))
-        
-        # 绘制光晕位置指示器 (如果在移动模式)
-        if self.current_tool == "move_overlay" and self.overlay_image:
-            # 映射光晕中心到屏幕坐标
-            # 这需要正向变换 (Transform Logic)
-            # 简化：只在未旋转时显示准确指示器，旋转后指示器可能偏离，但不影响拖拽手感
-            # 或者我们反推：直接重绘一个圆圈
-            pass 
+        self._refresh_histogram()
+        self.profiler.end_frame()
+        if self.show_profile_hud: self.info_label.config(text=self.profiler.hud_text())
+
+    def _push_dirty(self, scale, dirty, method):
+        """视口位置和缩放都没变：只重采样 dirty 对应的显示块并写进现有 photo"""
+        rx0, ry0, rx1, ry1 = self._view_region
+        x0, y0, x1, y1 = self.viewport.dirty_rect(dirty, scale)
+        x0, y0, x1, y1 = max(rx0, x0), max(ry0, y0), min(rx1, x1), min(ry1, y1)
+        if x0 < x1 and y0 < y1:
+            with self.profiler.stage("viewport"):
+                patch = self.viewport.render_box(scale, (x0, y0, x1, y1), method)
+            with self.profiler.stage("photo"):
+                self.surface.update(patch, (x0 - rx0, y0 - ry0))
+        self._refresh_histogram()
+        self.profiler.end_frame()
+        if self.show_profile_hud: self.info_label.config(text=self.profiler.hud_text())
+
+    def _histograms(self):
+        return self.histograms.sync(self.original_image, self.drawing_layer, self.params.get('crop'))
+
+    def _refresh_histogram(self):
+        """直方图面板随每帧刷新；统计来自代理，参数和图层都没变时不重算"""
+        if not self.original_image: return
+        with self.profiler.stage("histogram"):
+            hist = self._histograms().output_histogram(self.color_engine, self.params, self._overlay_layers())
+            if hist is self._hist_drawn: return
+            self._hist_drawn = hist
+            w = max(2, self.hist_canvas.winfo_width())
+            h = HIST_PANEL_HEIGHT
+            peak = max(1, max(hist[1:255] + hist[257:511] + hist[513:767])) # 两端的截断峰不参与归一化
+            for ch, item in enumerate(self.hist_lines):
+                counts = hist[ch * 256:(ch + 1) * 256]
+                points = []
+                for v, n in enumerate(counts):
+                    points += [v * (w - 1) / 255, h - 1 - (h - 2) * min(1.0, math.sqrt(n / peak))]
+                self.hist_canvas.coords(item, *points)
+
+    def toggle_profile_hud(self, event=None):
+        """F3：在信息栏显示上一帧各阶段耗时 (ms) 和滚动 p50/p95；设置了 LITEPIXEL_TRACE 时计时始终开启"""
+        self.show_profile_hud = not self.show_profile_hud
+        self.profiler.enabled = self.show_profile_hud or bool(self.profiler.trace_path)
+        self.info_label.config(text="性能 HUD 已开启，操作后刷新" if self.show_profile_hud else "Ready")
+
+    def _visible_rect(self):
+        """画布可见范围，换算到缩放后图像的坐标"""
+        x0 = self.canvas.canvasx(0) - self.img_pos_x
+        y0 = self.canvas.canvasy(0) - self.img_pos_y
+        return (x0, y0, x0 + self.canvas.winfo_width(), y0 + self.canvas.winfo_height())
+
+    def _ensure_viewport(self):
+        """平移后可见区若超出已渲染区域，补取瓦片"""
+        if not self.display_image or not self._view_region: return
+        x0, y0, x1, y1 = self._visible_rect()
+        if not self.viewport.covers(self._view_region, (x0, y0, x1, y1)):
+            self.render_canvas()
 
     # --- 历史记录 ---
 
+    @profiled("history.snapshot")
     def save_history_snapshot(self, event=None):
         if not self.original_image: return
-        state = {
-            'image': self.original_image.copy(),
-            'layer': self.drawing_layer.copy(),
-            'overlay': self.overlay_image, # 存引用即可，因为图片不改，只改位置
-            'overlay_pos': list(self.overlay_pos),
+        self.history.push(self._history_state())
+
+    def _history_state(self):
+        # 只存引用：原图不会被原地修改，绘画层的改动由 _record_layer 按瓦片保存
+        # 动图的当前帧随拖动替换且撤销时不恢复，不存以免历史钉住解码帧
+        return {
+            'image': None if self.animation else self.original_image,
+            'layer': self.drawing_layer,
+            'overlays': [dict(o) for o in self.overlays], # 光晕图只存引用，改动时整体替换而不是原地修改
+            'active_overlay': self.active_overlay,
             'params': self.params.copy()
         }
-        self.history_stack.append(state)
-        if len(self.history_stack) > self.history_max_steps: self.history_stack.pop(0)
 
+    def _record_layer(self, rect):
+        """绘画层 rect 区域即将被修改，先把原内容存进历史"""
+        self.history.record(self.drawing_layer, rect)
+
+    @profiled("history.undo")
     def undo(self):
-        if not self.history_stack: return
-        state = self.history_stack.pop()
-        self.original_image = state['image']
+        self._restore_history_state(self.history.undo(self._history_state()))
+
+    @profiled("history.redo")
+    def redo(self):
+        self._restore_history_state(self.history.redo(self._history_state()))
+
+    def _restore_history_state(self, state):
+        if not state: return
+        if not self.animation: # 拖动帧不进历史，动图撤销时停留在当前帧
+            self.original_image = state['image']
         self.drawing_layer = state['layer']
-        self.overlay_image = state.get('overlay')
-        self.overlay_pos = state.get('overlay_pos', [0,0])
+        self.overlays = state.get('overlays', [])
+        self.active_overlay = state.get('active_overlay')
         self.params = state['params']
+        self.layer_version += 1 # 图层瓦片已被原地写回
+        self.histograms.invalidate()
         for k, v in self.params.items():
             if k in self.sliders: self.sliders[k].set(v)
+        self._sync_overlay_props()
         self.update_preview()
 
     # --- 工具控制 ---
@@ -487,8 +3172,9 @@ class ImageEditorApp:
         msg = ""
         if tool == "brush": msg = f"画笔 (大小: {self.brush_size})"
         elif tool == "mosaic": msg = "局部马赛克"
-        elif tool == "move_overlay": msg = "拖动调整光晕位置"
+        elif tool == "move_overlay": msg = "拖动调整光晕位置，滚轮调整大小"
         self.prop_label.config(text=msg)
+        self._sync_overlay_props()
 
         cursor_map = {"move": "fleur", "crop": "crosshair", "brush": "pencil", "eraser": "dot", "move_overlay": "hand2"}
         self.canvas.config(cursor=cursor_map.get(tool, "arrow"))
@@ -509,10 +3195,17 @@ class ImageEditorApp:
 
     def _bind_shortcuts(self):
         self.root.bind("<Control-z>", lambda e: self.undo())
+        self.root.bind("<Control-y>", lambda e: self.redo())
+        self.root.bind("<Control-Z>", lambda e: self.redo()) # Ctrl+Shift+Z
         self.root.bind("<Control-s>", lambda e: self.save_image())
+        self.root.bind("<F3>", self.toggle_profile_hud)
+        self.root.bind("<Prior>", lambda e: self.show_adjacent(-1)) # PageUp / PageDown 切换同目录图片
+        self.root.bind("<Next>", lambda e: self.show_adjacent(1))
 
+    @profiled("event.mouse_down")
     def on_mouse_down(self, event):
         if not self.display_image: return
+        if not self.original_image and self.current_tool != "move": return # 全分辨率解码完之前只能平移
         cx = self.canvas.canvasx(event.x)
         cy = self.canvas.canvasy(event.y)
         
@@ -520,11 +3213,29 @@ class ImageEditorApp:
             self.save_history_snapshot()
             self.is_drawing = True
             self.last_draw_pos = (cx, cy)
-            if self.current_tool == "mosaic": self.processed_mosaic_blocks = set()
-            self.paint_stroke(cx, cy, cx, cy)
+            self._stroke_exact = self.display_scale == 1.0
+            self._full_render_deferred = self._full_render_job is not None
+            self._cancel_full_render() # 空闲渲染推迟到松手
+            if self.current_tool == "mosaic":
+                self.processed_mosaic_blocks = set()
+                self._mosaic_last = None
+            else:
+                self.stroke.begin(self.drawing_layer, int(self.brush_size), self.brush_color,
+                                  erase=self.current_tool == "eraser", before_draw=self._record_layer)
+            self.paint_stroke(cx, cy)
         
-        elif self.current_tool == "move_overlay":
+        elif self.current_tool == "move_overlay" and self.overlays:
             self.save_history_snapshot() # 移动前存记录
+            # 点中哪层就选中哪层 (从上往下找)，都没点中则移动当前层
+            px, py = self._screen_to_image(cx, cy)
+            for i in reversed(range(len(self.overlays))):
+                o = self.overlays[i]
+                ow, oh = o['image'].size
+                if abs(px - o['pos'][0]) <= ow / 2 and abs(py - o['pos'][1]) <= oh / 2:
+                    if i != self.active_overlay:
+                        self.active_overlay = i
+                        self._sync_overlay_props()
+                    break
             # 直接跳转位置到点击处 (Jump to click)
             self.update_overlay_pos_from_screen(cx, cy)
 
@@ -535,16 +3246,18 @@ class ImageEditorApp:
         elif self.current_tool == "move":
             self.canvas.scan_mark(event.x, event.y)
 
+    @profiled("event.mouse_drag")
     def on_mouse_drag(self, event):
         if not self.display_image: return
+        if not self.original_image and self.current_tool != "move": return # 同 on_mouse_down
         cx = self.canvas.canvasx(event.x)
         cy = self.canvas.canvasy(event.y)
         
         if self.is_drawing and self.last_draw_pos:
-            self.paint_stroke(self.last_draw_pos[0], self.last_draw_pos[1], cx, cy)
+            self.paint_stroke(cx, cy)
             self.last_draw_pos = (cx, cy)
         
-        elif self.current_tool == "move_overlay":
+        elif self.current_tool == "move_overlay" and self.overlays:
             self.update_overlay_pos_from_screen(cx, cy)
             
         elif self.current_tool == "crop" and self.crop_start:
@@ -555,111 +3268,258 @@ class ImageEditorApp:
             
         elif self.current_tool == "move":
             self.canvas.scan_dragto(event.x, event.y, gain=1)
+            self._ensure_viewport()
 
-    def update_overlay_pos_from_screen(self, screen_x, screen_y):
-        """将屏幕坐标映射回原图坐标，并更新滤镜位置"""
-        w, h = self.original_image.size
-        # 1. 屏幕 -> 显示图相对坐标
+    def _screen_to_image(self, screen_x, screen_y):
+        """画布坐标 -> 原图坐标；所有指针换算都走这里"""
+        # 1. 屏幕 -> 输出图坐标 (原图尺度)
         rx = (screen_x - self.img_pos_x) / self.view_scale
         ry = (screen_y - self.img_pos_y) / self.view_scale
-        
-        # 2. 逆变换 (Flip/Rotate)
-        px, py = self._inverse_transform_point(rx, ry, w, h)
-        
-        self.overlay_pos = [px, py]
-        self.update_preview()
+        # 2. 几何逆变换 (拉直 -> 翻转/旋转)，得到裁剪区域内的坐标
+        x0, y0, x1, y1 = crop_box(self.params, self.original_image.size) or (0, 0) + self.original_image.size
+        x, y = Geometry.from_params(self.params).inverse(rx, ry, (x1 - x0, y1 - y0))
+        return x + x0, y + y0
 
+    def update_overlay_pos_from_screen(self, screen_x, screen_y):
+        """将屏幕坐标映射回原图坐标，并更新当前光晕层的位置"""
+        overlay = self._current_overlay()
+        if not overlay: return
+        overlay['pos'] = list(self._screen_to_image(screen_x, screen_y))
+        self.update_preview(proxy=True)
+
+    @profiled("event.mouse_up")
     def on_mouse_up(self, event):
         self.is_drawing = False
-        if self.current_tool == "crop" and self.crop_start and hasattr(self, 'crop_end'):
+        if not self.original_image: # 全分辨率解码完之前只能平移
+            self.crop_start = self.crop_end = None
+            return
+        if self.current_tool == "crop" and self.crop_start and self.crop_end:
             self.apply_crop()
+        self.crop_start = self.crop_end = None # 下一次拖动必须从新的按下开始
         if self.current_tool in ["brush", "eraser", "mosaic"]:
-            self.update_preview()
+            self.layer_version += 1
+            # 显示图已按脏矩形增量刷新过；只有刷新不精确 (代理分辨率/任意角度旋转) 时才整图重渲染
+            if not self._stroke_exact or self._full_render_deferred: self.update_preview()
+            self._full_render_deferred = False
 
     # --- 绘图辅助 ---
     
-    def paint_stroke(self, x1, y1, x2, y2):
-        # 简化版绘图逻辑，复用 v2.1
-        width = int(self.brush_size * self.view_scale)
-        color = self.brush_color
-        
-        # 仅在Canvas绘制临时线
-        if self.current_tool != "mosaic":
-            self.canvas.create_line(x1, y1, x2, y2, fill=color if self.current_tool=="brush" else "#ffcccc", 
-                                   width=width, capstyle=tk.ROUND, tags="temp")
-                                   
-        # 映射回图层绘制
+    def paint_stroke(self, cx, cy):
+        """画布坐标 (cx, cy) 映射回原图坐标后续画当前一笔，并局部刷新预览"""
         w, h = self.drawing_layer.size
-        rx1, ry1 = (x1 - self.img_pos_x)/self.view_scale, (y1 - self.img_pos_y)/self.view_scale
-        rx2, ry2 = (x2 - self.img_pos_x)/self.view_scale, (y2 - self.img_pos_y)/self.view_scale
-        p1 = self._inverse_transform_point(rx1, ry1, w, h)
-        p2 = self._inverse_transform_point(rx2, ry2, w, h)
-        self._draw_on_layer(p1, p2)
-
-    def _inverse_transform_point(self, x, y, w, h):
-        # 逆变换: Rotate Back -> Flip H -> Flip V (顺序与正向相反)
-        # 简化处理：Flip
-        if self.params['flip_v']: y = h - y
-        if self.params['flip_h']: x = w - x
-        # 暂不处理复杂旋转逆变换，保持0度绘画最准
-        return (x, y)
-
-    def _draw_on_layer(self, p1, p2):
-        # 复用 v2.1 的绘画逻辑
-        draw = ImageDraw.Draw(self.drawing_layer)
-        width = int(self.brush_size)
-        if self.current_tool == "brush":
-            draw.line([p1, p2], fill=self.brush_color, width=width, joint="curve")
-            draw.ellipse((p1[0]-width/2, p1[1]-width/2, p1[0]+width/2, p1[1]+width/2), fill=self.brush_color)
-        elif self.current_tool == "eraser":
-            # 简单橡皮擦
-            pass # (省略重复代码，保持 v2.1 逻辑)
+        px, py = self._screen_to_image(cx, cy)
+        if self.current_tool in ("brush", "eraser"):
+            rect = self.stroke.stroke_to(px, py)
+            if rect: self._refresh_region(rect)
+        elif self.current_tool == "mosaic":
+            cells = mosaic_cells(self._mosaic_last or (px, py), (px, py), max(1, self.brush_size) / 2,
+                                 self.mosaic_strength, (w, h))
+            self._mosaic_last = (px, py)
+            cells -= self.processed_mosaic_blocks # 同一笔里每块只算一次
+            if not cells: return
+            self.processed_mosaic_blocks |= cells
+            size = self.mosaic_strength
+            self._record_layer((min(c[0] for c in cells) * size, min(c[1] for c in cells) * size,
+                                (max(c[0] for c in cells) + 1) * size, (max(c[1] for c in cells) + 1) * size))
+            self._refresh_region(apply_mosaic(self.original_image, self.drawing_layer, cells, size))
+
+    @profiled("stroke.refresh")
+    def _refresh_region(self, rect):
+        """绘画层 rect (原图坐标) 改动后只重新合成这一块，贴到显示图、视口和直方图代理上"""
+        self.histograms.update(rect)
+        result = self.pipeline.render_region(self.original_image, self.params, self.drawing_layer,
+                                             self._overlay_layers(), rect)
+        if result is None: return # 笔画在裁剪区域外
+        patch, (x0, y0) = result
+        if self.display_scale != 1.0:
+            # 显示的是代理图：按比例缩小后贴上，松手后再整图渲染
+            ds = self.display_scale
+            x1, y1 = math.ceil((x0 + patch.size[0]) * ds), math.ceil((y0 + patch.size[1]) * ds)
+            x0, y0 = math.floor(x0 * ds), math.floor(y0 * ds)
+            patch = patch.resize((max(1, x1 - x0), max(1, y1 - y0)), Image.Resampling.BILINEAR)
+            self._stroke_exact = False
+
+        # 显示图可能来自渲染缓存，第一次改动前复制一份
+        if self._owned_display is not self.display_image:
+            self.display_image = self.display_image.copy()
+            self._owned_display = self.display_image
+            self.viewport.adopt(self.display_image)
+        w, h = self.display_image.size
+        box = (x0, y0, min(w, x0 + patch.size[0]), min(h, y0 + patch.size[1]))
+        if box[0] >= box[2] or box[1] >= box[3]: return
+        self.viewport.update(box, patch.crop((0, 0, box[2] - x0, box[3] - y0)))
+        self.render_canvas(dirty=box)
 
     def apply_crop(self):
-        # 复用 v2.1 裁剪逻辑
-        if not self.crop_rect_id: return
+        """裁剪只改 params['crop'] (原图坐标)，不复制原图和绘画层；可撤销，"取消裁剪"恢复整图"""
+        if not (self.crop_rect_id and self.original_image): return
+        x1, y1, x2, y2 = self.canvas.coords(self.crop_rect_id)
+        self.canvas.delete(self.crop_rect_id)
+        self.crop_rect_id = None
+        # 四个角都映射回原图，取外接矩形 (旋转/翻转后屏幕上的左上角不一定是原图的左上角)
+        corners = [self._screen_to_image(x, y) for x in (x1, x2) for y in (y1, y2)]
+        # 已有裁剪时在当前区域内再裁
+        rx0, ry0, rx1, ry1 = crop_box(self.params, self.original_image.size) or (0, 0) + self.original_image.size
+        box = (max(rx0, round(min(p[0] for p in corners))), max(ry0, round(min(p[1] for p in corners))),
+               min(rx1, round(max(p[0] for p in corners))), min(ry1, round(max(p[1] for p in corners))))
+        if box[0] >= box[2] or box[1] >= box[3]: return
         self.save_history_snapshot()
-        coords = self.canvas.coords(self.crop_rect_id)
-        x1, y1, x2, y2 = coords
-        rx1, ry1 = (x1-self.img_pos_x)/self.view_scale, (y1-self.img_pos_y)/self.view_scale
-        rx2, ry2 = (x2-self.img_pos_x)/self.view_scale, (y2-self.img_pos_y)/self.view_scale
-        box = (min(rx1,rx2), min(ry1,ry2), max(rx1,rx2), max(ry1,ry2))
-        try:
-            w, h = self.original_image.size
-            box = (max(0, box[0]), max(0, box[1]), min(w, box[2]), min(h, box[3]))
-            self.original_image = self.original_image.crop(box)
-            self.drawing_layer = self.drawing_layer.crop(box)
-            self.overlay_image = None # 裁剪后重置滤镜位置以免越界
-            self.canvas.delete(self.crop_rect_id)
-            self.crop_rect_id = None
-            self.update_preview()
-        except: pass
+        self.params['crop'] = box
+        self.update_preview()
+
+    def clear_crop(self):
+        if not (self.original_image and self.params.get('crop')): return
+        self.save_history_snapshot()
+        self.params['crop'] = None
+        self.update_preview()
 
     # --- 批量处理 ---
+    def current_recipe(self):
+        """把当前参数和光晕导出为可用于批处理的配方"""
+        overlays, crop = [], None
+        if self.original_image:
+            w, h = self.original_image.size
+            overlays = [{'source': o['source'], 'pos': (o['pos'][0] / w, o['pos'][1] / h),
+                         'opacity': o['opacity'], 'blend': o['blend']} for o in self.overlays]
+            box = self.params.get('crop')
+            if box: crop = (box[0] / w, box[1] / h, box[2] / w, box[3] / h)
+        return make_recipe(self.params, overlays, crop)
+
     def open_batch_processor_window(self):
-        # 复用 v2.1 批量处理代码
-        messagebox.showinfo("提示", "批量处理功能已在 v2.1 中实现 (此处省略以节省篇幅)")
+        win = tk.Toplevel(self.root)
+        win.title("批量处理")
+        win.geometry("560x300")
+        win.configure(bg=self.colors["bg"])
+
+        src_var, dst_var = tk.StringVar(), tk.StringVar()
+        fmt_var = tk.StringVar(value="保持原格式")
+        skip_var = tk.BooleanVar(value=True)
+
+        def dir_row(label, var):
+            f = tk.Frame(win, bg=self.colors["bg"])
+            f.pack(fill=tk.X, padx=15, pady=5)
+            tk.Label(f, text=label, bg=self.colors["bg"], fg="white", width=8, anchor="w").pack(side=tk.LEFT)
+            tk.Entry(f, textvariable=var).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+            tk.Button(f, text="选择", bg=self.colors["btn_active"], fg="white", relief=tk.FLAT,
+                      command=lambda: var.set(filedialog.askdirectory() or var.get())).pack(side=tk.LEFT)
+
+        dir_row("输入目录", src_var)
+        dir_row("输出目录", dst_var)
+
+        f_opt = tk.Frame(win, bg=self.colors["bg"])
+        f_opt.pack(fill=tk.X, padx=15, pady=5)
+        tk.Label(f_opt, text="输出格式", bg=self.colors["bg"], fg="white", width=8, anchor="w").pack(side=tk.LEFT)
+        tk.OptionMenu(f_opt, fmt_var, "保持原格式", ".jpg", ".png", ".webp").pack(side=tk.LEFT, padx=5)
+        tk.Checkbutton(f_opt, text="跳过已处理", variable=skip_var, bg=self.colors["bg"], fg="white",
+                       selectcolor=self.colors["panel"]).pack(side=tk.LEFT, padx=10)
+
+        bar = ttk.Progressbar(win, mode="determinate")
+        bar.pack(fill=tk.X, padx=15, pady=10)
+        status = tk.Label(win, text="配方取自当前参数和光晕", bg=self.colors["bg"], fg="#aaa", anchor="w")
+        status.pack(fill=tk.X, padx=15)
+
+        events = queue.Queue()
+        state = {'processor': None}
+
+        def start():
+            if state['processor']: return
+            if not src_var.get() or not dst_var.get():
+                messagebox.showwarning("提示", "请先选择输入和输出目录", parent=win)
+                return
+            out_ext = None if fmt_var.get() == "保持原格式" else fmt_var.get()
+            processor = BatchProcessor(src_var.get(), dst_var.get(), self.current_recipe(),
+                                       out_ext=out_ext, skip_done=skip_var.get())
+            state['processor'] = processor
+
+            def work():
+                try:
+                    events.put(("done", processor.run(lambda n, total, path: events.put(("progress", (n, total, path))))))
+                except Exception as e:
+                    events.put(("error", str(e)))
+            threading.Thread(target=work, daemon=True).start()
+            poll()
+
+        def poll():
+            # 批处理线程只往队列里放消息，界面更新都在主线程
+            try:
+                while True:
+                    kind, data = events.get_nowait()
+                    if kind == "progress":
+                        n, total, path = data
+                        bar.config(maximum=max(1, total), value=n)
+                        status.config(text=f"[{n}/{total}] {os.path.basename(path)}")
+                    else:
+                        state['processor'] = None
+                        if kind == "error":
+                            messagebox.showerror("错误", data, parent=win)
+                        else:
+                            msg = f"完成 {data['done']}，跳过 {data['skipped']}，失败 {len(data['failed'])}"
+                            if data['cancelled']: msg = "已取消。" + msg
+                            status.config(text=msg)
+                            if data['failed']:
+                                messagebox.showwarning("部分失败", msg + f"\n详情见输出目录下的 {BATCH_REPORT}", parent=win)
+                        return
+            except queue.Empty:
+                pass
+            win.after(100, poll)
+
+        def cancel():
+            if state['processor']:
+                state['processor'].cancel()
+                status.config(text="正在取消…")
+
+        def save_recipe():
+            path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("配方", "*.json")], parent=win)
+            if path:
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump(self.current_recipe(), f, ensure_ascii=False, indent=2)
+
+        f_btn = tk.Frame(win, bg=self.colors["bg"])
+        f_btn.pack(fill=tk.X, padx=15, pady=15)
+        tk.Button(f_btn, text="开始", bg=self.colors["accent"], fg="white", relief=tk.FLAT, command=start).pack(side=tk.LEFT, padx=2)
+        tk.Button(f_btn, text="取消", bg="#d63031", fg="white", relief=tk.FLAT, command=cancel).pack(side=tk.LEFT, padx=2)
+        tk.Button(f_btn, text="保存配方 (命令行用)", bg=self.colors["btn_active"], fg="white", relief=tk.FLAT,
+                  command=save_recipe).pack(side=tk.RIGHT, padx=2)
 
     # --- 其他 ---
-    def on_wheel(self, event): self.on_zoom(1.1 if event.delta > 0 else 0.9)
+    @profiled("event.wheel")
+    def on_wheel(self, event):
+        factor = 1.1 if event.delta > 0 else 0.9
+        overlay = self._current_overlay()
+        if self.current_tool == "move_overlay" and overlay and isinstance(overlay['source'], dict):
+            # 移光晕工具下滚轮缩放光晕本身
+            self.save_history_snapshot()
+            radius = overlay['source'].get("radius", 100)
+            self.adjust_overlay(radius=max(8, min(4000, round(radius * factor))))
+        else:
+            self.on_zoom(factor)
     def on_zoom(self, scale):
         self.view_scale *= scale
         self.render_canvas()
+    @profiled("event.param")
     def on_param_change(self, key, val):
         self.params[key] = float(val)
-        self.update_preview()
-    def reset_params(self):
+        self.update_preview(proxy=True)
+    def reset_params(self, skip_render=False):
         self.save_history_snapshot()
-        self.overlay_image = None # 重置
+        self.overlays = [] # 重置
+        self.active_overlay = None
+        self._sync_overlay_props()
         self.params = {k: 0 if k=='blur' else 1.0 for k in self.params}
         self.params['rotate'] = 0
+        self.params['angle'] = 0.0
+        self.params['crop'] = None
         self.params['flip_h'] = False
         self.params['flip_v'] = False
         for k,s in self.sliders.items(): s.set(self.params[k])
-        self.update_preview()
+        if not skip_render: self.update_preview()
     def magic_enhance(self):
+        """按代理直方图自动选亮度/对比度 (自动色阶) 和饱和度"""
+        if not self.original_image: return
         self.save_history_snapshot()
-        self.params.update({'contrast': 1.2, 'saturation': 1.3})
+        self.params.update(self._histograms().suggest_enhance())
+        for k in ('brightness', 'contrast', 'saturation'):
+            if k in self.sliders: self.sliders[k].set(self.params[k])
         self.update_preview()
     def rotate_image(self):
         self.save_history_snapshot()
@@ -671,15 +3531,168 @@ class ImageEditorApp:
         else: self.params['flip_v'] = not self.params['flip_v']
         self.update_preview()
     def save_image(self):
-        if self.display_image:
-            f = filedialog.asksaveasfilename(defaultextension=".png")
-            if f: self.display_image.save(f)
+        """选好文件名后立即返回，渲染和编码都在后台进行 (编码参数沿用导出窗口的设置)"""
+        if not (self.display_image and self.original_image): return
+        f = filedialog.asksaveasfilename(defaultextension=".png",
+                                         filetypes=[("PNG", "*.png"), ("JPEG", "*.jpg *.jpeg"), ("WebP", "*.webp"),
+                                                    ("GIF", "*.gif")])
+        if f:
+            fmt = export_format(f)
+            self.start_export([{'path': f, 'format': fmt, 'options': dict(self.export_options[fmt])}])
+
+    # --- 导出 ---
+    def _export_render(self):
+        """在主线程拍下当前状态，返回可在工作线程里调用的全分辨率渲染函数 (不经预览缓存)；
+        动图导出时传入各帧，按同样的参数、绘画层和光晕渲染 (各帧并行，不共用色彩引擎的统计缓存)"""
+        image, params, overlays = self.original_image, self.params.copy(), self._overlay_layers()
+        engine = None if self.animation else self.color_engine
+        layer = self.drawing_layer.copy() if self.drawing_layer.getbbox() else None # 绘画层之后还会被原地修改
+        return lambda frame=image: render_image(frame, params, layer, overlays, color_engine=engine)
+
+    def start_export(self, targets, progress=None):
+        """后台导出；进度显示在信息栏，progress(n, total, 说明) 可选 (在主线程回调)。动图按帧流式导出"""
+        render = self._export_render()
+        job = AnimationExportJob(self.animation, render, targets) if self.animation else ExportJob(render, targets)
+        events = queue.Queue()
+
+        def work():
+            try:
+                events.put(("done", job.run(lambda n, total, what: events.put(("progress", (n, total, what))))))
+            except Exception as e:
+                events.put(("error", f"{type(e).__name__}: {e}"))
+        threading.Thread(target=work, name="export", daemon=True).start()
+
+        def poll():
+            try:
+                while True:
+                    kind, data = events.get_nowait()
+                    if kind == "progress":
+                        n, total, what = data
+                        self.info_label.config(text=f"导出中 [{n}/{total}] {os.path.basename(what)}")
+                        if progress: progress(n, total, what)
+                        continue
+                    if kind == "error":
+                        self.info_label.config(text="导出失败")
+                        messagebox.showerror("导出失败", data)
+                    else:
+                        self.info_label.config(text=f"已导出 {len(data['written'])} 个文件")
+                        if data['failed']:
+                            messagebox.showerror("导出失败", "\n".join(f"{os.path.basename(x['file'])}: {x['error']}"
+                                                                    for x in data['failed']))
+                    if progress: progress(None, None, data)
+                    return
+            except queue.Empty:
+                pass
+            self.root.after(50, poll)
+        poll()
+        return job
+
+    def open_export_window(self):
+        """导出到多个格式/尺寸，各格式的编码参数可调"""
+        if not self.original_image:
+            messagebox.showwarning("提示", "请先打开一张图片")
+            return
+        win = tk.Toplevel(self.root)
+        win.title("导出")
+        win.geometry("560x380")
+        win.configure(bg=self.colors["bg"])
+
+        labels = {'quality': "质量", 'progressive': "渐进式", 'optimize': "优化", 'compress_level': "压缩级别",
+                  'method': "压缩方法", 'lossless': "无损"}
+        ranges = {'quality': (1, 100), 'compress_level': (0, 9), 'method': (0, 6)}
+        base = os.path.splitext(self.file_path)[0] + "_edit" if self.file_path else ""
+        path_var, sizes_var = tk.StringVar(value=base), tk.StringVar(value="100")
+
+        f = tk.Frame(win, bg=self.colors["bg"])
+        f.pack(fill=tk.X, padx=15, pady=5)
+        tk.Label(f, text="文件名", bg=self.colors["bg"], fg="white", width=8, anchor="w").pack(side=tk.LEFT)
+        tk.Entry(f, textvariable=path_var).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        tk.Button(f, text="选择", bg=self.colors["btn_active"], fg="white", relief=tk.FLAT,
+                  command=lambda: path_var.set(os.path.splitext(filedialog.asksaveasfilename(parent=win))[0]
+                                               or path_var.get())).pack(side=tk.LEFT)
+
+        # 每个格式一行：是否导出 + 该格式的编码参数
+        enabled, option_vars = {}, {}
+        for fmt, opts in self.export_options.items():
+            f = tk.Frame(win, bg=self.colors["bg"])
+            f.pack(fill=tk.X, padx=15, pady=3)
+            enabled[fmt] = tk.BooleanVar(value=fmt == "PNG")
+            tk.Checkbutton(f, text=fmt, variable=enabled[fmt], width=6, anchor="w", bg=self.colors["bg"], fg="white",
+                           selectcolor=self.colors["panel"]).pack(side=tk.LEFT)
+            option_vars[fmt] = {}
+            for key, value in opts.items():
+                if isinstance(value, bool):
+                    var = tk.BooleanVar(value=value)
+                    tk.Checkbutton(f, text=labels[key], variable=var, bg=self.colors["bg"], fg="white",
+                                   selectcolor=self.colors["panel"]).pack(side=tk.LEFT, padx=4)
+                else:
+                    var = tk.IntVar(value=value)
+                    tk.Label(f, text=labels[key], bg=self.colors["bg"], fg="#ddd").pack(side=tk.LEFT, padx=(4, 0))
+                    tk.Scale(f, from_=ranges[key][0], to=ranges[key][1], variable=var, orient=tk.HORIZONTAL, length=90,
+                             bg=self.colors["bg"], fg="#ddd", highlightthickness=0, troughcolor="#555").pack(side=tk.LEFT)
+                option_vars[fmt][key] = var
+
+        f = tk.Frame(win, bg=self.colors["bg"])
+        f.pack(fill=tk.X, padx=15, pady=5)
+        tk.Label(f, text="尺寸 (%)", bg=self.colors["bg"], fg="white", width=8, anchor="w").pack(side=tk.LEFT)
+        tk.Entry(f, textvariable=sizes_var, width=20).pack(side=tk.LEFT, padx=5)
+        tk.Label(f, text="多个尺寸用逗号分隔，如 100, 50", bg=self.colors["bg"], fg="#aaa").pack(side=tk.LEFT)
+
+        bar = ttk.Progressbar(win, mode="determinate")
+        bar.pack(fill=tk.X, padx=15, pady=10)
+        status = tk.Label(win, text="", bg=self.colors["bg"], fg="#aaa", anchor="w")
+        status.pack(fill=tk.X, padx=15)
+        state = {'job': None}
+
+        def progress(n, total, what):
+            if not win.winfo_exists(): return
+            if n is None:
+                state['job'] = None
+                status.config(text=f"已导出 {len(what['written'])} 个文件" if isinstance(what, dict) else "导出失败")
+                return
+            bar.config(maximum=total, value=n)
+            status.config(text=f"[{n}/{total}] {os.path.basename(what)}")
+
+        def start():
+            if state['job']: return
+            try:
+                sizes = [float(x) for x in sizes_var.get().replace("，", ",").split(",") if x.strip()]
+            except ValueError:
+                sizes = []
+            if not path_var.get() or not sizes or any(x <= 0 for x in sizes):
+                messagebox.showwarning("提示", "请填写文件名和有效的尺寸", parent=win)
+                return
+            targets = []
+            for fmt, on in enabled.items():
+                if not on.get(): continue
+                self.export_options[fmt] = {k: v.get() for k, v in option_vars[fmt].items()}
+                for pct in sizes:
+                    suffix = "" if pct == 100 else f"_{pct:g}"
+                    targets.append({'path': path_var.get() + suffix + EXPORT_FORMATS[fmt][0], 'format': fmt,
+                                    'options': dict(self.export_options[fmt]), 'scale': pct / 100})
+            if not targets:
+                messagebox.showwarning("提示", "请至少选择一种格式", parent=win)
+                return
+            state['job'] = self.start_export(targets, progress)
+
+        f_btn = tk.Frame(win, bg=self.colors["bg"])
+        f_btn.pack(fill=tk.X, padx=15, pady=15)
+        tk.Button(f_btn, text="开始", bg=self.colors["accent"], fg="white", relief=tk.FLAT, command=start).pack(side=tk.LEFT, padx=2)
+        tk.Button(f_btn, text="取消", bg="#d63031", fg="white", relief=tk.FLAT,
+                  command=lambda: state['job'] and state['job'].cancel()).pack(side=tk.LEFT, padx=2)
 
 if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support() # 打包后的 exe 启动批处理子进程需要
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        sys.exit(run_batch_cli(sys.argv[2:]))
+
+    startup = StartupTimer(verbose="--startup-report" in sys.argv)
     root = tk.Tk()
     try:
         from ctypes import windll
         windll.shcore.SetProcessDpiAwareness(1)
     except: pass
-    app = ImageEditorApp(root)
-    root.mainloop()
\ No newline at end of file
+    app = ImageEditorApp(root, startup)
+    root.mainloop()
+    app.profiler.dump_trace() # 仅在设置了 LITEPIXEL_TRACE 时写文件
\ No newline at end of file